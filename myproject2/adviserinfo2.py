@@ -1,11 +1,18 @@
-import os, re, gzip
+import os, re, gzip, codecs, zipfile, shutil
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 import numpy as np
 import pandas as pd
 from stagelib import (OSPath, Csv, Folder,
     to_single_space, mergedicts,
-    chunker, floating_point, appendData,
+    chunker, floating_point,
     from_json, to_json, mkpath,
-    parsexml, readtable)
+    readtable)
 
 import stagelib.record
 from scraper import download_formadvs, get_dailyxml_path, download_dailyxml
@@ -13,6 +20,14 @@ from stagelib.stage import Stage
 
 from db import newfolder
 import db
+from headercache import HEADERS
+from lookup import CategoryLookup, matchcategories
+from instrument import RunReport
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
 
 re_PERCENTAGE = re.compile(r'(^\d+)%.*?$')
 
@@ -24,6 +39,11 @@ DESCRIPTION_MODELS = {
     'disclosures' : db.Disclosure
         }
 
+TYPE_CATEGORIES = ['client_types', 'compensation', 'pct_aum', 'disclosures']
+re_TYPECOLUMNS = re.compile('|'.join(TYPE_CATEGORIES))
+
+LOADED_MODELS = [db.Adviser, db.Filing, db.SecFiler] + INFOMODELS + list(DESCRIPTION_MODELS.values())
+
 SCHEDULE_D_MODELS = {
     'people' : db.Person,
     'funds' : db.PrivateFund,
@@ -70,27 +90,107 @@ numericrank = {
 
 re_NUMBERSPECIFY = re.compile('^More than')
 
+PERCENTRANK = CategoryLookup(percentrank, 'percentrank', ignore = r'^(?:[YN]|[\d\.]+%?)$')
+NUMERICRANK = CategoryLookup(numericrank, 'numericrank', ignore = r'^[\d\.]+$')
+
 def get_filingdate(path):
     return pd.to_datetime(re.sub(r'^.*?ia(\d+)\.zip', r'\1', path))
 
+def get_dailyxmldate(path):
+    return pd.to_datetime(re.sub(r'^.*?_(\d+_\d+_\d+)\.xml\.gz$', r'\1', path), format = '%m_%d_%Y')
+
 def list_formadvs():
     return sorted([
         {'date' : get_filingdate(path), 'filename' : path}
         for path in Folder.listdir(zipfolder)
             ], key = lambda k: k['date'])
 
-def read_formadv(formadv, **kwds):
+def openraw(path):
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        return archive.open(archive.namelist()[0])
+    return open(path, 'rb')
+
+def sniff_encoding(path, blocksize = 1 << 20):
+    """'utf-8' if all of `path` (or the file zipped in it) decodes as UTF-8, else 'latin-1'."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    f = openraw(path)
+    try:
+        for block in iter(partial(f.read, blocksize), b''):
+            decoder.decode(block)
+        decoder.decode(b'', True)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    finally:
+        f.close()
+    return 'utf-8'
+
+def read_formadv(formadv, chunksize = None, **kwds):
+    if chunksize:
+        kwds['chunksize'] = chunksize
     return readtable(formadv.filename,
         true_values = 'Y',
         false_values = 'N',
-        na_values = ['NONE'])
+        na_values = ['NONE'],
+        **kwds)
+
+def firmrecord(firm, flat = 'FormInfo'):
+    """Flatten one `Firm` element into a dict.
+
+    Attributes are named by their element's path below the firm
+    (`MainAddr_City`, `Rgstn_St`), repeated siblings numbered from the second
+    (`NoticeFiled_States_2_St`); text-only elements by their path alone.  Under
+    `flat` the question items keep their bare attribute and tag names (`Q1I`),
+    falling back to the path for a name already taken.
+    """
+    record = dict(firm.attrib)
+    def walk(elem, path, bare):
+        counts = {}
+        for child in elem:
+            n = counts[child.tag] = counts.get(child.tag, 0) + 1
+            childpath = path + [child.tag if n == 1 else '{}_{}'.format(child.tag, n)]
+            childbare = bare or child.tag == flat
+            for k, v in child.attrib.items():
+                name = k if childbare and k not in record else '_'.join(childpath + [k])
+                record.setdefault(name, v)
+            text = (child.text or '').strip()
+            if text and not len(child):
+                name = child.tag if childbare and child.tag not in record else '_'.join(childpath)
+                record.setdefault(name, text)
+            walk(child, childpath, childbare)
+    walk(firm, [], False)
+    return record
+
+def iter_dailyxml(path = None, chunksize = 5000, tag = 'Firm'):
+    """Yield DataFrames of `chunksize` `tag` records parsed straight from the gzipped feed.
+    Each element is dropped from the tree once read, so memory stays at one chunk."""
+    f = gzip.open(path or get_dailyxml_path(), 'rb')
+    try:
+        rows, stack = [], []
+        for event, elem in iterparse(f, events = ('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
 
-def read_dailyxml():
-    f = gzip.open(get_dailyxml_path(), 'rb')
-    for chunk in chunker(f, chunksize = 100):
-        appendData(mkpath(xmlfolder, 'daily.xml'), ''.join(chunk))
-    f.close() #catch IOerror
-    return pd.DataFrame(parsexml('dailyxml.xml', 'Firm', 'FormInfo'))
+            stack.pop()
+            if elem.tag == tag:
+                rows.append(firmrecord(elem))
+                if stack:
+                    stack[-1].remove(elem)
+                elem.clear()
+                if len(rows) >= chunksize:
+                    yield pd.DataFrame(rows)
+                    rows = []
+        if rows:
+            yield pd.DataFrame(rows)
+    finally:
+        f.close()
+
+def read_dailyxml(path = None, chunksize = None):
+    if chunksize:
+        return iter_dailyxml(path, chunksize = chunksize)
+    chunks = list(iter_dailyxml(path))
+    return pd.concat(chunks, ignore_index = True) if chunks else pd.DataFrame()
 
 ##this needs to be rewritten to extract and parse schedule D's from the source.
 def parse_scheduleDjson(crd):
@@ -117,67 +217,229 @@ def parse_scheduleDjson(crd):
                 data.append(mergedicts(business, row))
     return data
 
-def load_formadv(formadv): #formadv db entry
-    df = readtable(formadv.outfile, encoding = 'latin')
-    db.Adviser.insertdf(df)
-    db.Filing.insertdf(df, extrafields = [])
-    idmap = db.Filing.getdict(formadv)
-    df['filing'] = df.crd.map(idmap)
-    db.SecFiler.insertdf(df, extrafields = ['adviser'])
-
-    for table in INFOMODELS:
-        table.insertdf(df, chunksize = 5000)
-    
-    typesmap = FormadvStage.get_types(df)
+def write_columnar(df, path):
+    """Write `df` as parquet.  Object columns are stored as text, as they would be in the CSV."""
+    df = df.copy()
+    df.columns = df.columns.map(str)
+    for col in df.columns[(df.dtypes == object).values]:
+        values = df[col]
+        df[col] = values.where(values.isnull(), values.astype(type(u'')))
+    df.to_parquet(path, index = False)
+
+def discard_columnar(formadv):
+    """Remove a columnar file left by an earlier run, so it cannot shadow a new CSV."""
+    if OSPath.exists(formadv.columnarfile):
+        os.remove(formadv.columnarfile)
+
+def load_columns(names):
+    """The subset of the preprocessed columns `write_formadv` actually uses."""
+    fields = set(['crd', 'rowhash'])
+    for model in LOADED_MODELS:
+        fields.update(model._meta.fields)
+    return [name for name in names if name in fields or re_TYPECOLUMNS.search(name)]
+
+def read_preprocessed(formadv, columns = None):
+    """Read the preprocessed stage of `formadv`, preferring the typed columnar
+    file unless the CSV was written after it.
+
+    `columns` is a list of names or a function picking them from the file's
+    header; it only applies to the columnar file.
+    """
+    path = formadv.loadfile
+    if parquet is not None and path == formadv.columnarfile:
+        if columns is not None:
+            names = parquet.ParquetFile(path).schema.names
+            if callable(columns):
+                columns = columns(names)
+            columns = [name for name in names if name in set(columns)]
+        return parquet.read_table(path, columns = columns).to_pandas()
+    return readtable(formadv.outfile, encoding = 'latin')
+
+def prepare_formadv(formadv, report = None):
+    report = report or RunReport()
+    df = report.timed('read_preprocessed', read_preprocessed, formadv, columns = load_columns)
+    return df, report.timed('get_types', FormadvStage.get_types, df)
+
+def prepare_report(formadv):
+    """`prepare_formadv` with a fresh run report, for the process pool."""
+    report = RunReport(formadv.id, 'load')
+    return prepare_formadv(formadv, report = report) + (report,)
+
+def write_prepared(formadv, checksum, prepared, stat = None):
+    df, typesmap, report = prepared
+    write_formadv(formadv, df, typesmap, checksum = checksum, report = report, stat = stat)
+    report.save()
+
+def load_formadv(formadv, checksum = None, stat = None): #formadv db entry
+    write_prepared(formadv, checksum, prepare_report(formadv), stat = stat)
+
+def write_formadv(formadv, df, typesmap, checksum = None, batchsize = 4, report = None, stat = None):
+    """Insert one prepared FormADV in a single `LoadSession`, skipping tables
+    the manifest says are already loaded."""
+    if checksum is None:
+        stat, checksum = formadv.filestat(), formadv.checksum()
+    report = report or RunReport()
+    descriptions = db.Description.registry()
     if typesmap:
-        db.Description.tryinsert(typesmap['descriptions'])
-        textdict = db.Description.textdict()
-        
+        report.timed('descriptions', descriptions.add, typesmap['descriptions'])
+
+    with db.LoadSession(formadv, checksum, batchsize = batchsize, report = report, stat = stat) as session:
+        session.insert(db.Adviser, df)
+        if session.insert(db.Filing, df, extrafields = []) is not None:
+            session.run(db.LatestFiling._meta.db_table, db.LatestFiling.refresh, formadv)
+
+        idmap = db.Filing.getdict(formadv)
+        df['filing'] = df.crd.map(idmap)
+        session.insert(db.SecFiler, df, extrafields = ['adviser'])
+
+        for table in INFOMODELS:
+            session.insert(table, df, chunksize = 5000)
+
         for category, typestable in DESCRIPTION_MODELS.items():
-            if category in typesmap:
-                typesdata = typesmap[category]
+            typesdata = typesmap.get(category, pd.DataFrame())
+            if not typesdata.empty:
                 typesdata = typesdata.assign(
-                    description = typesdata.description.map(textdict),
+                    description = descriptions.getids(typesdata.description),
                     filing = typesdata.adviser.map(idmap))
-        
+
                 typesdata = typesdata.loc[
                     ~typesdata.description.contains(r'^$|^ +$')
                         ]
 
-                typestable.insertdf(typesdata, extrafields = ['filing'])    
+            session.insert(typestable, typesdata, extrafields = ['filing'])
+
+        #a firm whose rows were rolled back must stay 'changed' so the next delta reloads it
+        if 'rowhash' in df and not session.failed:
+            session.run(db.FirmHash._meta.db_table, db.FirmHash.store, df, formadv.date)
+
+def load_dailyxml(path = None, delta = True):
+    """Normalize and load a daily IAPD feed as its own FormADV entry.  With
+    `delta`, only firms whose record changed since their last load are written."""
+    path = path or get_dailyxml_path()
+    formadv = db.FormADV.get_or_create(date = get_dailyxmldate(path).date(), filename = path)[0]
+    FormadvStage().normfile(formadv, dailyxml = True, delta = delta)
+    load_formadv(formadv)
+    return formadv
+
+def list_entries(start = 1):
+    return [formadv for formadv in db.FormADV.select()
+        .order_by(db.FormADV.date, db.FormADV.id) if formadv.id >= start]
+
+def list_unloaded(start = 1):
+    """(formadv, checksum, stat) for each entry from `start` on whose preprocessed
+    file is not fully loaded.
+
+    A file whose size and mtime match the manifest is taken as loaded without
+    reading it; only the others are hashed.
+    """
+    entries = []
+    for formadv in list_entries(start):
+        stat = formadv.filestat()
+        if stat is None:
+            db.db_logger.warning("{}: not preprocessed yet, skipped".format(formadv))
+            continue
+        if db.LoadManifest.isunchanged(formadv, stat, LOADED_MODELS):
+            continue
 
-def load_formadvs(start = 1):
-    for formadv in db.FormADV.select():
-        if formadv.id >= start:
-            load_formadv(formadv)
+        checksum = formadv.checksum()
+        if db.LoadManifest.isloaded(formadv, checksum, LOADED_MODELS):
+            db.LoadManifest.restat(formadv, checksum, stat)
+        else:
+            entries.append((formadv, checksum, stat))
+    return entries
+
+def load_formadvs(start = 1, processes = None):
+    """Load every FormADV from entry `start` on, in filing-date order.
+
+    Preprocessed files whose size and mtime, or else checksum, match a
+    complete manifest are skipped and partially loaded ones resume at the
+    first table not yet recorded.
+    With `processes`, parsing and `get_types` run in a process pool at most
+    `processes` files ahead, while this process stays the only writer so
+    inserts (and the ids they hand out) happen in the same order as a
+    serial load.
+    """
+    entries = list_unloaded(start)
+    if not processes:
+        for formadv, checksum, stat in entries:
+            load_formadv(formadv, checksum, stat)
+        return
+
+    pool = Pool(processes)
+    pending = deque()
+    try:
+        for formadv, checksum, stat in entries:
+            pending.append((formadv, checksum, stat,
+                pool.apply_async(prepare_report, (formadv,))))
+            if len(pending) > processes:
+                formadv, checksum, stat, prepared = pending.popleft()
+                write_prepared(formadv, checksum, prepared.get(), stat)
+
+        while pending:
+            formadv, checksum, stat, prepared = pending.popleft()
+            write_prepared(formadv, checksum, prepared.get(), stat)
+    except BaseException:
+        pool.terminate()    #don't wait on files queued ahead of the failure
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+def read_scheduleDs():
+    for folder in Folder.listdir('data', pattern = r'\d+$'):
+        try:
+            yield from_json(mkpath(folder, 'predictiveops.json'))
+        except IOError:
+            continue
 
 def load_scheduleD(data):
-    crd = int(data['crd'])
-    innerdata = data['data']
+    load_scheduleD_batch([data])
 
-    if 'businesses' in innerdata:
-        db.AdviserRelation.create_relationships(crd, innerdata['businesses'])
+def load_scheduleD_batch(batch, registry = None, report = None):
+    report = report or RunReport()
+    businesses, funds, people, cases = {}, {}, {}, {}
+    for data in batch:
+        crd = int(data['crd'])
+        innerdata = data['data']
 
-    if 'funds' in data:
-        db.FundRelation.create_relationships(crd, data['funds'])
+        if 'businesses' in innerdata:
+            businesses[crd] = innerdata['businesses']
 
-    if 'people' in data:
-        db.Person.addpeople(crd, data['people'])
+        if 'funds' in data:
+            funds[crd] = data['funds']
 
-    if 'regulatory_drps' in innerdata:
-        db.Courtcase.addcases(crd, innerdata['regulatory_drps'])
+        if 'people' in data:
+            people[crd] = data['people']
 
-def load_scheduleDs():
-    folders = [
-        folder for folder in Folder.listdir('data', pattern = r'\d+$')
-            ]
+        if 'regulatory_drps' in innerdata:
+            cases[crd] = innerdata['regulatory_drps']
 
-    for folder in folders:
-        try:
-            data = from_json(mkpath(folder, 'predictiveops.json'))
-            load_scheduleD(data)
-        except IOError:
-            continue
+    registry = registry or db.BusinessRegistry()
+    with report.stage(db.AdviserRelation._meta.db_table, len(businesses)):
+        for crd, rows in businesses.items():
+            db.AdviserRelation.create_relationships(crd, rows, registry = registry)
+
+    if funds:
+        fundids = report.timed(db.PrivateFund._meta.db_table, db.PrivateFund.addfunds, funds)
+        with report.stage(db.FundRelation._meta.db_table, len(funds)):
+            for crd, rows in funds.items():
+                db.FundRelation.create_relationships(crd, rows,
+                    fundids = fundids, registry = registry)
+    report.timed(db.OtherBusiness._meta.db_table, registry.flush)
+
+    if people:
+        report.timed(db.Person._meta.db_table, db.Person.addpeople_batch, people)
+
+    if cases:
+        report.timed(db.Courtcase._meta.db_table, db.Courtcase.addcases_batch, cases)
+
+def load_scheduleDs(batchsize = 500):
+    report = RunReport('scheduleD', 'load')
+    registry = report.timed('registry', db.BusinessRegistry().load)
+    for batch in report.iterate('read_scheduleDs', chunker(read_scheduleDs(), chunksize = batchsize)):
+        load_scheduleD_batch(list(batch), registry = registry, report = report)
+    report.save()
 
 def setup():
     #download_formadvs()
@@ -188,26 +450,41 @@ def setup():
 
 class FormadvStage(Stage):
     FIELDSPATH = mkpath('config', 'fieldsconfig.json')
+    _typesplans = {}
     def __init__(self):
         super(FormadvStage, self).__init__('formadv')
+        self.report = RunReport()
 
     @classmethod
-    def processfiles(cls, start = 1, **kwds):
+    def processfiles(cls, start = 1, processes = None, **kwds):
         advprsr = cls()
         advprsr.info("Starting at entry number {}".format(start))
-        for formadv in db.FormADV.select():
-            if formadv.id >= start:
-                advprsr.info("Currently processing '{}'".format(formadv.filename))
-                advprsr.normfile(formadv)
+        formadvs = list_entries(start)
+        if processes:
+            pool = Pool(processes)
+            try:
+                for formadv in pool.imap_unordered(normformadv, formadvs):
+                    advprsr.info("Processed '{}'".format(formadv.filename))
+            except BaseException:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+            return
+
+        for formadv in formadvs:
+            advprsr.info("Currently processing '{}'".format(formadv.filename))
+            advprsr.normfile(formadv)
 
     @staticmethod
     def get_number(df, field = 'numberofclients'):
-        data = df[field].copy()
+        data = df[field]
         mask = data.notnull()
-        data.loc[data.contains(re_NUMBERSPECIFY)] = np.nan
+        data = data.where(~matchcategories(data, re_NUMBERSPECIFY))
         __ = df.loc[mask, '{}_specify'.format(field)]
-        return data.modify(mask,
-            data.fillna(__)).quickmap(numericrank)
+        return NUMERICRANK(data.modify(mask, data.fillna(__)))
 
     @staticmethod
     def cleantext(text, key):
@@ -216,35 +493,92 @@ class FormadvStage(Stage):
                 text.replace("{}_".format(key), '').split('_'))
         return to_single_space(text)
 
+    @staticmethod
+    def typesplan(columns):
+        """Classify a header once for `get_types`.  Each category maps to
+        the positions of its columns, an index into its cleaned descriptions
+        and is_specify/is_other flags, all as integer or boolean arrays.
+        Plans are kept in the header cache, so a known layout is never reclassified."""
+        columns = tuple(columns)
+        if columns in FormadvStage._typesplans:
+            return FormadvStage._typesplans[columns]
+
+        layout = (HEADERS.get(columns) or {}).get('types')
+        if layout is None:
+            layout = {}
+            for key in TYPE_CATEGORIES:
+                matched = [(i, str(c)) for i, c in enumerate(columns) if re.search(key, str(c))]
+                if not matched:
+                    continue
+
+                positions, names = zip(*matched)
+                texts = []; codes = []
+                for name in names:
+                    text = FormadvStage.cleantext(name, key)
+                    if text not in texts:
+                        texts.append(text)
+                    codes.append(texts.index(text))
+
+                layout[key] = {
+                    'positions' : list(positions),
+                    'codes' : codes,
+                    'texts' : texts,
+                    'specify' : [bool(re.search("{}_(?:other_)?specify$".format(key), name)) for name in names],
+                    'other' : [bool(re.search("{}_(?:other_)?other$".format(key), name)) for name in names],
+                        }
+            HEADERS.store(columns, types = layout)
+
+        plan = {key : {
+            'positions' : np.array(p['positions'], dtype = int),
+            'codes' : np.array(p['codes'], dtype = int),
+            'texts' : np.array(p['texts'], dtype = object),
+            'specify' : np.array(p['specify'], dtype = bool),
+            'other' : np.array(p['other'], dtype = bool),
+                } for key, p in layout.items()}
+
+        FormadvStage._typesplans[columns] = plan
+        return plan
+
     @staticmethod
     def get_types(df):
-        categories = ['client_types', 'compensation', 'pct_aum', 'disclosures']
         fields = ['adviser', 'text', 'specific', 'percentage']
         typesmap = {'descriptions' : []}
-        for key in categories:
-            data = df.filter(regex = key).stack().reset_index()
-            if data.empty:
+        plan = FormadvStage.typesplan(df.columns)
+        crds = df.crd.values
+        for key in TYPE_CATEGORIES:
+            if key not in plan:
                 continue
 
-            __maps = {}
-            for _key in ('specify', 'other',):
-                __ = data.level_1.contains("{}_(?:other_)?{}$".format(key, _key))
-                __maps.update({
-                    _key : {'map' : data.loc[__].get_mapper('level_0', 0), 'mask' : __}
-                        })
-
-            mask_o = __maps['other']['mask']
-            map_s = __maps['specify']['map']
-            map_o = __maps['other']['map']
-
-            descriptions = data.assign(
-                text = data.level_1.modify(
-                    mask_o, data.level_0.map(map_s)
-                        ).quickmap(FormadvStage.cleantext, key), #
-                specific = data.level_1.modify(mask_o, True, elsevalue = False), #
-                adviser = data.level_0.map(df.crd.to_dict()), #
-                percentage = data[0].quickmap(percentrank)#
-                    ).ix[:, fields]
+            p = plan[key]
+            values = df.iloc[:, p['positions']].values
+            notnull = pd.notnull(values)
+            rows, cols = np.nonzero(notnull) #row-major, same order as stack()
+            if not len(rows):
+                continue
+
+            specify = np.empty(len(values), dtype = object)
+            specify[:] = np.nan
+            for j in np.flatnonzero(p['specify']):
+                specify = np.where(notnull[:, j], values[:, j], specify)
+
+            spectext = {text : FormadvStage.cleantext(text, key)
+                for text in pd.unique(specify[pd.notnull(specify)])}
+
+            other = p['other'][cols]
+            text = p['texts'][p['codes'][cols]]
+            text[other] = [spectext.get(t, np.nan) for t in specify[rows[other]]]
+
+            ranked = ~p['specify'][cols] #specify cells hold free text, never a rank
+            percentage = np.empty(len(rows), dtype = object)
+            percentage[:] = np.nan
+            percentage[ranked] = PERCENTRANK(values[rows[ranked], cols[ranked]]).values
+
+            descriptions = pd.DataFrame({
+                'adviser' : crds[rows],
+                'text' : text,
+                'specific' : other,
+                'percentage' : percentage
+                    }, columns = fields)
 
             qty = descriptions.percentage.to_numeric(force = True)
             if key == 'disclosures':
@@ -261,8 +595,7 @@ class FormadvStage(Stage):
                     .to_dict(orient = 'records'))
 
             typesmap.update({
-                key : descriptions.loc[dropmask]\
-                    .dropna().rename(columns = {'text' : 'description'})
+                key : descriptions.rename(columns = {'text' : 'description'})
                     })
 
         typesmap['descriptions'] = [dict(t) for t in {
@@ -278,19 +611,25 @@ class FormadvStage(Stage):
         return df
 
     def normdf(self, df, formadv, **kwds):
-        df = super(FormadvStage, self).normdf(df, **kwds)
+        report = self.report
+        df = report.timed('Stage.normdf', super(FormadvStage, self).normdf, df, **kwds)
         nflds = self.numeric_fields
         num = df[nflds].copy()
-        if _num.any(axis = 1).any():  #these did not provide a value
+        if num.any(axis = 1).any():  #these did not provide a value
             df[nflds] = num.fillna(0)
 
-        return df.assign(
+        df = df.assign(
             formadv = formadv.id,
             adviser = df.crd,
-            numberofclients = self.get_number(df),
-            numberofemployees = self.get_number(df, field = 'numberofemployees'),
+            numberofclients = report.timed('get_number', self.get_number, df),
+            numberofemployees = report.timed('get_number', self.get_number, df, field = 'numberofemployees'),
             date = formadv.date,
-                ).clean_addresses().addnames()
+                )
+
+        with report.stage('clean_addresses', len(df)) as counts:
+            df = df.clean_addresses().addnames()
+            counts['rows_out'] = len(df)
+        return df
 
     def writefile(self, df, outfile, **kwds):
         while True:
@@ -300,12 +639,94 @@ class FormadvStage(Stage):
                 self.error("Encoding troubles"); self.error(e)
                 kwds['encoding'] = 'utf-8'
 
-    def normfile(self, formadv, dailyxml = False, **kwds):
-        df = read_formadv(formadv.filename)
+    def delta(self, df):
+        """The firms in `df` whose normalized record is new or changed since it was
+        last loaded, with a `rowhash` column for `write_formadv` to store."""
+        df = df.assign(rowhash = db.FirmHash.rowhashes(df))
+        changed = db.FirmHash.changed(df)
+        self.info("{} of {} firms new or changed".format(changed.sum(), len(df)))
+        return df.loc[changed]
+
+    def normfile(self, formadv, dailyxml = False, delta = False, chunksize = None, columnar = None, **kwds):
+        """Normalize `formadv` into the preprocessed stage.
+
+        `columnar` (default: whenever pyarrow is installed) writes the typed
+        parquet file read by `read_preprocessed` instead of the CSV.  Streaming
+        with `chunksize` always writes CSV.  `delta` keeps only the changed
+        firms of a daily feed.
+        """
+        dailyxml = dailyxml or formadv.isdailyxml
+        report = self.report = RunReport(formadv.id, 'normfile')
+        if chunksize:
+            rows = self.streamfile(formadv, dailyxml = dailyxml, delta = delta, chunksize = chunksize, **kwds)
+            report.save()
+            return rows
+
+        if dailyxml:
+            df = report.timed('read_dailyxml', read_dailyxml, formadv.filename)
+        else:
+            df = report.timed('read_formadv', read_formadv, formadv)
         df = self.normdf(df, formadv, **kwds)
-        self.writefile(df, mkpath(preprocessed, formadv.outfile))
+        if dailyxml and delta:
+            df = report.timed('delta', self.delta, df)
+        if columnar is None:
+            columnar = parquet is not None
+
+        with report.stage('write', len(df)):
+            if columnar:
+                write_columnar(df, formadv.columnarfile)
+            else:
+                discard_columnar(formadv)
+                self.writefile(df, mkpath(preprocessed, formadv.outfile))
+        report.save()
         return df
 
+    def streamfile(self, formadv, dailyxml = False, delta = False, chunksize = 50000, **kwds):
+        """Normalize `formadv` `chunksize` rows at a time, appending each chunk to its outfile.
+
+        The encoding is settled before the first row is read and reused for the
+        output, so memory stays at about one chunk.  Rows go to a headerless
+        body file under the union of the columns seen so far (new ones at the
+        end), and the header is written last.  Returns the rows written.
+        """
+        outfile = mkpath(preprocessed, formadv.outfile)
+        body = outfile + '.body'
+        discard_columnar(formadv)
+        if OSPath.exists(body):
+            os.remove(body)
+        if dailyxml:
+            encoding = 'utf-8'
+            chunks = read_dailyxml(formadv.filename, chunksize = chunksize)
+        else:
+            encoding = sniff_encoding(formadv.filename)
+            chunks = read_formadv(formadv, chunksize = chunksize, encoding = encoding)
+        self.info("Streaming '{}' ({}) in chunks of {} rows".format(
+            formadv.filename, encoding, chunksize))
+
+        columns, rows = [], 0
+        for chunk in self.report.iterate('read', chunks):
+            chunk = self.normdf(chunk, formadv, **kwds)
+            if dailyxml and delta:
+                chunk = self.report.timed('delta', self.delta, chunk)
+            with self.report.stage('write', len(chunk)):
+                seen = set(columns)
+                columns.extend(c for c in chunk.columns if c not in seen)
+                chunk.reindex(columns = columns).to_csv(body,
+                    index = False, header = False, mode = 'a', encoding = encoding)
+            rows += len(chunk)
+
+        with self.report.stage('write'):
+            pd.DataFrame(columns = columns).to_csv(outfile, index = False, encoding = encoding)
+            if OSPath.exists(body):
+                with open(outfile, 'ab') as out, open(body, 'rb') as fh:
+                    shutil.copyfileobj(fh, out)
+                os.remove(body)
+        return rows
+
+def normformadv(formadv):
+    FormadvStage().normfile(formadv)
+    return formadv
+
 pd.DataFrame.addnames = FormadvStage.addnames
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+"""Benchmarks for the Form ADV ingestion hot paths, run on synthetic files.
+
+Everything runs against a local SQLite database (`ADVISERINFO_SQLITE`, a temp
+file by default) built by `db.setup()`, so no SEC zips or MySQL host are needed:
+
+    python benchmark.py --advisers 1000 10000 50000 --quarters 2
+
+Timings come from the pipeline's own `RunReport`, so the stages inside
+`normdf` and every table written by `write_formadv` are listed too.
+"""
+import os, sys, json, tempfile
+from collections import OrderedDict
+
+os.environ.setdefault('ADVISERINFO_SQLITE',
+    os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+
+import db
+import synthetic
+from instrument import RunReport
+from adviserinfo2 import FormadvStage, read_formadv, write_formadv
+
+def legacyfiling():
+    """`formadv.AdvFiling`, or None where the older IapdDB pipeline does not import."""
+    try:
+        from formadv import AdvFiling
+    except Exception: #adviserinfo.py is python-2 only and needs selenium/stagelib
+        return None
+    return AdvFiling
+
+def resetdb():
+    db.database.close()
+    if os.path.exists(db.SQLITE_PATH):
+        os.remove(db.SQLITE_PATH)
+    db._descriptions = None
+    db.setup()
+
+def run(sizes = (1000,), quarters = 1, layout = 'items', seed = 0):
+    """One `RunReport` per adviser count, covering all of its quarters."""
+    reports = OrderedDict()
+    stage = FormadvStage()
+    AdvFiling = legacyfiling()
+    for advisers in sizes:
+        resetdb()
+        report = stage.report = reports[advisers] = RunReport(phase = 'benchmark')
+        outdir = os.path.join(synthetic.OUTDIR, str(advisers))
+        for filingdate, path in synthetic.generate(advisers, quarters,
+                layout = layout, seed = seed, outdir = outdir):
+            formadv = db.FormADV.create(date = filingdate, filename = path)
+
+            raw = report.timed('read_formadv', read_formadv, formadv)
+            df = report.timed('FormadvStage.normdf', stage.normdf, raw.copy(), formadv)
+            typesmap = report.timed('FormadvStage.get_types', FormadvStage.get_types, df)
+            report.timed('write_formadv', write_formadv, formadv, df, typesmap, report = report)
+
+            if AdvFiling is not None:
+                advfiling = AdvFiling(path)
+                renamed = raw.rename(columns = advfiling.fields_map).mangle_cols()
+                report.timed('AdvFiling.get_checkbox_answers', AdvFiling.get_checkbox_answers, renamed)
+                report.timed('AdvFiling.normalize', advfiling.normalize, raw.copy())
+    return reports
+
+def printreports(reports, out = sys.stdout):
+    out.write("{:>8}  {:<32}{:>7}{:>10}{:>10}{:>10}{:>12}{:>14}{:>14}\n".format(
+        'advisers', 'stage', 'calls', 'self', 'total', 'cpu', 'rows/sec', 'peak growth', 'process peak'))
+    for advisers, report in reports.items():
+        for name, s in report.stages.items():
+            rate = s['rows_in'] / s['total'] if s['total'] and s['rows_in'] else 0
+            out.write("{:>8}  {:<32}{:>7}{:>10.3f}{:>10.3f}{:>10.3f}{:>12,.0f}{:>11.1f} MB{:>11.1f} MB\n".format(
+                advisers, name, s['calls'], s['wall'], s['total'], s['cpu'], rate,
+                s['peak_growth_mb'], s['process_peak_mb'] or 0))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--advisers', type = int, nargs = '+', default = [1000])
+    parser.add_argument('--quarters', type = int, default = 1)
+    parser.add_argument('--layout', choices = sorted(synthetic.LAYOUTS), default = 'items')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--json', help = 'also write the reports to this file')
+    args = parser.parse_args()
+
+    reports = run(args.advisers, args.quarters, layout = args.layout, seed = args.seed)
+    printreports(reports)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(OrderedDict((str(k), r.todict()) for k, r in reports.items()), fh, indent = 2)
@@ -1,6 +1,15 @@
-import re
+import os, re
+import time
+import hashlib
+import tempfile
+from collections import OrderedDict, defaultdict
+from datetime import datetime
 from functools import partial
+import numpy as np
 import pandas as pd
+from pandas.util import hash_array, hash_pandas_object
+from peewee import (Case, SqliteDatabase, MySQLDatabase, PrimaryKeyField, DataError,
+    BigIntegerField, DoubleField)
 from stagelib.db import *
 from stagelib import ospath, Folder, mergedicts, floating_point, readjson, newfolder, joinpath
 from stagelib.record import getname
@@ -18,12 +27,18 @@ unzippedfolder = advfolder('unzipped')
 xmlfolder = advfolder('dailyxml')
 
 preprocessed = advfolder('preprocessed')
+staging = advfolder('staging')
 
-database = getdb('adviserinfo', hostalias = 'production')
+SQLITE_PATH = os.environ.get('ADVISERINFO_SQLITE')
+if SQLITE_PATH: #local database for benchmarks and tests
+    database = SqliteDatabase(SQLITE_PATH)
+else:
+    database = getdb('adviserinfo', hostalias = 'production')
 
 def setup():
     database.create_tables([
         FormADV,
+        LoadManifest,
         Adviser,
         AlternateName,
         Person,
@@ -33,6 +48,8 @@ def setup():
         Address,
         Website,
         Filing,
+        LatestFiling,
+        FirmHash,
         SecFiler,
         Numbers,
         Description,
@@ -50,9 +67,298 @@ def setup():
 
 BaseModel = get_basemodel(database)
 
+def maxrows(nfields):
+    """Rows per multi-row statement that keep us under the backend's bind parameter limit."""
+    limit = 999 if isinstance(database, SqliteDatabase) else 20000
+    return max(1, limit // max(nfields, 1))
+
+def native(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+def nativerows(rows):
+    return [{k : native(v) for k, v in row.items()} for row in rows]
+
+def insertignore(query):
+    """Run an insert query, skipping rows that hit a unique key."""
+    sql, params = query.sql()
+    verb = 'INSERT OR IGNORE' if isinstance(database, SqliteDatabase) else 'INSERT IGNORE'
+    return database.execute_sql(verb + sql[len('INSERT'):], params)
+
+def bulkinsert(model, rows, chunksize = None, ignore = False):
+    rows = nativerows(rows)
+    if not rows:
+        return 0
+    chunksize = chunksize or maxrows(len(rows[0]))
+    with database.atomic():
+        for i in range(0, len(rows), chunksize):
+            query = model.insert_many(rows[i:i + chunksize])
+            if ignore:
+                insertignore(query)
+            else:
+                query.execute()
+    return len(rows)
+
+def bulkupdate(model, rows, fields, chunksize = None):
+    """Update `fields` on many rows with one `SET f = CASE id WHEN ...` statement per chunk."""
+    pk = model._meta.primary_key
+    rows = nativerows(rows)
+    chunksize = chunksize or maxrows(2 * len(fields) + 1)
+    with database.atomic():
+        for i in range(0, len(rows), chunksize):
+            chunk = rows[i:i + chunksize]
+            ids = [row[pk.name] for row in chunk]
+            (model.update(**{
+                f : Case(pk, [(row[pk.name], row[f]) for row in chunk]) for f in fields
+                    }).where(pk << ids).execute())
+    return len(rows)
+
+BULKLOAD_ROWS = 20000
+
+def loadfields(model, df):
+    """Model fields with a column in `df`, skipping auto-increment keys."""
+    return [f for f in model._meta.sorted_fields
+        if f.name in df.columns and not isinstance(f, PrimaryKeyField)]
+
+def quotenames(fields):
+    q = database.quote_char
+    return ', '.join('{0}{1}{0}'.format(q, f.db_column) for f in fields)
+
+DUPLICATE_KEY = 1062
+
+def infilevalue(value):
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, (str, type(u''))):
+        return value.replace('\\', '\\\\')
+    return value
+
+def loadinfile(model, df, fields):
+    """LOAD DATA LOCAL INFILE from a staging CSV.
+
+    LOCAL loads turn errors into warnings, so they are read back inside the
+    load's transaction: rows hitting a unique key are skipped, anything else
+    (a NULL in a NOT NULL column, a value that does not fit) raises
+    `DataError` and rolls the load back.  SHOW WARNINGS lists at most
+    `max_error_count` of them, so the full count is checked too: beyond one
+    duplicate-key warning per skipped row, there must be none.
+    """
+    data = df.ix[:, [f.name for f in fields]].copy()
+    for col in data.columns:
+        if data[col].dtype == bool:
+            data[col] = data[col].astype(int)
+        elif data[col].dtype == object:
+            data[col] = data[col].map(infilevalue)
+
+    fd, path = tempfile.mkstemp(suffix = '.csv', dir = staging)
+    os.close(fd)
+    try:
+        data.to_csv(path, index = False, header = False, na_rep = r'\N',
+            encoding = 'utf-8', line_terminator = '\n')
+        with database.atomic():
+            cursor = database.execute_sql(
+                "LOAD DATA LOCAL INFILE %s INTO TABLE {} CHARACTER SET utf8 "
+                "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+                "LINES TERMINATED BY '\\n' ({})".format(model._meta.db_table, quotenames(fields)),
+                (path.replace(os.sep, '/'),))
+            count = cursor.rowcount
+            total = database.execute_sql('SHOW COUNT(*) WARNINGS').fetchone()[0]
+            listed = database.execute_sql('SHOW WARNINGS').fetchall()
+            problems = [w for w in listed if int(w[1]) != DUPLICATE_KEY]
+            unexplained = total - (len(data) - count)
+            if problems or unexplained > 0:
+                raise DataError("{}: {} warning(s) loading {} rows ({} inserted), e.g. {}".format(
+                    model._meta.db_table, total, len(data), count,
+                    problems[0][2] if problems else 'not listed past max_error_count'))
+        return count
+    finally:
+        os.remove(path)
+
+def insertorignore(model, df, fields, chunksize = 50000):
+    """SQLite bulk path: one prepared INSERT OR IGNORE run through executemany."""
+    sql = "INSERT OR IGNORE INTO {} ({}) VALUES ({})".format(
+        model._meta.db_table, quotenames(fields), ', '.join('?' * len(fields)))
+
+    data = df.ix[:, [f.name for f in fields]]
+    count = 0
+    with database.atomic():
+        cursor = database.get_cursor()
+        for i in range(0, len(data), chunksize):
+            cursor.executemany(sql, [tuple(native(v) for v in row) for row in
+                data.iloc[i:i + chunksize].itertuples(index = False)])
+            count += cursor.rowcount
+    return count
+
+def uniquekey(model, df):
+    """Fields of the first unique key of `model` that `df` fully covers.
+
+    Unique indexes come first, then a natural primary key, then a
+    `unique` field; empty when `df` covers none of them.
+    """
+    for fields, unique in model._meta.indexes:
+        if unique and all(f in df.columns for f in fields):
+            return list(fields)
+    pk = model._meta.primary_key
+    if not isinstance(pk, PrimaryKeyField) and pk.name in df.columns:
+        return [pk.name]
+    for f in model._meta.sorted_fields:
+        if f.unique and f.name in df.columns:
+            return [f.name]
+    return []
+
+def dropexisting(model, df):
+    """Rows of `df` that no unique key of `model` already has on file.
+
+    Keys are matched as the database would (see `InternTable`); a row with a
+    NULL in its key never collides, as in a unique index.
+    """
+    keyfields = uniquekey(model, df)
+    if df.empty or not keyfields:
+        return df
+
+    table = InternTable(model, keyfields, casefold = True)
+    rows = df[keyfields].to_dict('records')
+    table.loadin(keyfields[0], [table.dbvalue(keyfields[0], row[keyfields[0]]) for row in rows])
+    if not table.ids:
+        return df
+    keys = [table.getkey(row) for row in rows]
+    return df.loc[[None in key or key not in table for key in keys]]
+
+def bulkload(model, df):
+    """Load `df` with the backend's native bulk path.  None when there is none.
+
+    Rows whose unique key is already on file are left out, as the unique
+    index would reject them anyway.
+    """
+    if not isinstance(database, (MySQLDatabase, SqliteDatabase)):
+        return None
+    df = dropexisting(model, df)
+    fields = loadfields(model, df)
+    if df.empty or not fields:
+        return 0
+    if isinstance(database, MySQLDatabase):
+        return loadinfile(model, df, fields)
+    return insertorignore(model, df, fields)
+
+def existing(field, values, chunksize = 500):
+    """Subset of `values` already present in `field`."""
+    values = list(set(native(v) for v in values))
+    found = set()
+    for i in range(0, len(values), chunksize):
+        found.update(row[0] for row in field.model_class\
+            .select(field)\
+            .where(field << values[i:i + chunksize]).tuples())
+    return found
+
+def normkey(value):
+    try:
+        if pd.isnull(value):
+            return None
+    except (TypeError, ValueError):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+class InternTable(object):
+    """In-memory map of a table's natural key to its id.
+
+    Keys found in the map are resolved without touching the database; misses
+    are queued by `intern` and written in one batch by `flush`, which first
+    looks up any queued key that is already on file.  Key values are compared
+    as the columns store them (CharFields cut to `max_length`, FloatFields to
+    the 6 significant digits a MySQL FLOAT returns) and, with
+    `casefold`, as a case-insensitive collation does (case and trailing
+    spaces ignored).  With `ignore`, `flush` skips rows that a unique index
+    still finds on file and picks up their ids on the reload.
+    """
+    def __init__(self, model, keyfields, casefold = False, ignore = False):
+        self.model = model
+        self.keyfields = keyfields
+        self.casefold = casefold
+        self.ignore = ignore
+        self.ids = {}
+        self.pending = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __getitem__(self, key):
+        return self.ids[key]
+
+    def dbvalue(self, field, value):
+        value = normkey(value)
+        column = self.model._meta.fields[field]
+        width = getattr(column, 'max_length', None)
+        if width and isinstance(value, (bytes, type(u''))):
+            value = value[:width]
+        elif isinstance(column, FloatField) and isinstance(value, (int, float, np.number)):
+            value = float('%.6g' % value)
+        return value
+
+    def keyvalue(self, field, value):
+        value = self.dbvalue(field, value)
+        if self.casefold and isinstance(value, (bytes, type(u''))):
+            value = value.rstrip().lower()
+        return value
+
+    def getkey(self, row):
+        return tuple(self.keyvalue(f, row.get(f)) for f in self.keyfields)
+
+    def load(self, where = None):
+        model = self.model
+        query = model.select(model._meta.primary_key,
+            *[getattr(model, f) for f in self.keyfields])
+        if where is not None:
+            query = query.where(where)
+
+        for row in query.tuples().iterator():
+            self.ids[tuple(self.keyvalue(f, v) for f, v in zip(self.keyfields, row[1:]))] = row[0]
+        return self
+
+    def loadin(self, field, values, chunksize = 500):
+        values = list(set(native(v) for v in values))
+        for i in range(0, len(values), chunksize):
+            self.load(getattr(self.model, field) << values[i:i + chunksize])
+        return self
+
+    def intern(self, row):
+        key = self.getkey(row)
+        if key not in self.ids and key not in self.pending:
+            self.pending[key] = row
+        return key
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        field = self.keyfields[0]
+        values = [self.dbvalue(field, row.get(field)) for row in self.pending.values()]
+        self.loadin(field, values)
+        rows = [row for key, row in self.pending.items() if key not in self.ids]
+        inserted = bulkinsert(self.model, rows, ignore = self.ignore)
+        if inserted:
+            self.loadin(field, values)
+        self.pending.clear()
+        return inserted
+
 class AdvBaseModel(BaseModel):
     @classmethod
-    def insertdf(cls, df, extrafields = ['filing', 'adviser', 'formadv'], **kwds):
+    def insertdf(cls, df, extrafields = ['filing', 'adviser', 'formadv'], bulk = None, **kwds):
+        """Frames of `BULKLOAD_ROWS` or more (or `bulk = True`) go through
+        `bulkload`; everything else, and backends without a bulk path, through stagelib."""
+        if bulk is None:
+            bulk = len(df) >= BULKLOAD_ROWS
+        if bulk:
+            count = bulkload(cls, df)
+            if count is not None:
+                return count
         return super(AdvBaseModel, cls).insertdf(df, extrafields = extrafields, **kwds)
 
 class FormADV(AdvBaseModel):
@@ -74,10 +380,50 @@ class FormADV(AdvBaseModel):
         for filename in Folder.listdir(self.unzippedfolder):
             return filename
 
+    @property
+    def stem(self):
+        """Name of this entry's preprocessed files: the date, plus the source
+        name for daily feeds, which can share a date with a monthly file."""
+        stem = self.date.strftime("%m%d%y")
+        if self.isdailyxml:
+            stem += '_' + os.path.basename(self.filename)[:-len('.xml.gz')]
+        return stem
+
     @property
     def outfile(self):
-        return joinpath(preprocessed,
-            self.date.strftime("%m%d%y_output.csv"))
+        return joinpath(preprocessed, self.stem + "_output.csv")
+
+    @property
+    def columnarfile(self):
+        return joinpath(preprocessed, self.stem + "_output.parquet")
+
+    @property
+    def isdailyxml(self):
+        return self.filename.endswith('.xml.gz')
+
+    @property
+    def loadfile(self):
+        """The preprocessed file a load reads: the columnar one unless the CSV is newer."""
+        path, csvpath = self.columnarfile, self.outfile
+        if ospath.exists(path) and not (ospath.exists(csvpath)
+            and os.path.getmtime(csvpath) > os.path.getmtime(path)):
+            return path
+        return csvpath
+
+    def filestat(self):
+        """(size, mtime) of `loadfile`; None if it has not been written yet."""
+        try:
+            stat = os.stat(self.loadfile)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def checksum(self, blocksize = 1 << 20):
+        digest = hashlib.md5()
+        with open(self.loadfile, 'rb') as f:
+            for block in iter(partial(f.read, blocksize), b''):
+                digest.update(block)
+        return digest.hexdigest()
 
     @classmethod
     def datesdict(cls):
@@ -86,6 +432,161 @@ class FormADV(AdvBaseModel):
     def __repr__(self):
         return self.date.strftime("FormADV: {}/%Y-%m-%d".format(ospath.basename(self.filename)))
 
+class LoadManifest(BaseModel):
+    """What has been loaded from each FormADV's preprocessed file, one row per
+    table.  The file's size and mtime let an unchanged file be recognized
+    without hashing it."""
+    formadv = ForeignKeyField(FormADV, related_name = 'manifest')
+    tablename = CharField(max_length = 50)
+    checksum = CharField(max_length = 32)
+    filesize = BigIntegerField(null = True)
+    filemtime = DoubleField(null = True)
+    rows_parsed = IntegerField(null = True)
+    rows_imported = IntegerField(null = True)
+    loaded = DateTimeField(default = datetime.now)
+
+    class Meta:
+        db_table = 'load_manifest'
+        indexes = (
+            (('formadv', 'tablename'), True),
+                )
+
+    @classmethod
+    def completed(cls, formadv, checksum):
+        """Tables already loaded from this exact version of the file."""
+        return set(row[0] for row in cls.select(cls.tablename)
+            .where((cls.formadv == formadv.id) & (cls.checksum == checksum))
+            .tuples())
+
+    @classmethod
+    def isloaded(cls, formadv, checksum, tables):
+        return cls.completed(formadv, checksum)\
+            .issuperset(table._meta.db_table for table in tables)
+
+    @classmethod
+    def isunchanged(cls, formadv, stat, tables):
+        """True if every table was loaded from a file of this (size, mtime)."""
+        size, mtime = stat
+        return set(row[0] for row in cls.select(cls.tablename)
+            .where((cls.formadv == formadv.id) & (cls.filesize == size) & (cls.filemtime == mtime))
+            .tuples()).issuperset(table._meta.db_table for table in tables)
+
+    @classmethod
+    def restat(cls, formadv, checksum, stat):
+        """Note that the file loaded with `checksum` now has this (size, mtime)."""
+        size, mtime = stat
+        return cls.update(filesize = size, filemtime = mtime)\
+            .where((cls.formadv == formadv.id) & (cls.checksum == checksum)).execute()
+
+    @classmethod
+    def record(cls, formadv, checksum, table, rows_parsed, rows_imported, stat = None):
+        with database.atomic():
+            cls.delete().where((cls.formadv == formadv.id) &
+                (cls.tablename == table._meta.db_table)).execute()
+            size, mtime = stat or (None, None)
+            cls.insert(formadv = formadv.id,
+                tablename = table._meta.db_table,
+                checksum = checksum,
+                filesize = size,
+                filemtime = mtime,
+                rows_parsed = native(rows_parsed),
+                rows_imported = native(rows_imported)).execute()
+
+def cputime():
+    """User plus system CPU seconds of this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+class LoadSession(object):
+    """Write one FormADV over a single connection.
+
+    Tables are grouped `batchsize` to a transaction and each runs under its own
+    savepoint, so a failing table is rolled back, logged and left out of the
+    manifest while the rest of the batch commits.  `timings` holds the rows,
+    insert seconds and (per batch) commit seconds of every table; a
+    `RunReport` passed as `report` gets every table as a stage as well.
+    """
+    def __init__(self, formadv, checksum, batchsize = 4, report = None, stat = None):
+        self.formadv = formadv
+        self.checksum = checksum
+        self.stat = stat
+        self.batchsize = batchsize
+        self.report = report
+        self.done = LoadManifest.completed(formadv, checksum)
+        self.timings = OrderedDict()
+        self.failed = []
+        self.pending = []
+        self.transaction = None
+
+    def __enter__(self):
+        database.get_conn()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        elif self.transaction is not None:
+            self.transaction.__exit__(exc_type, exc, tb)
+            self.transaction = None
+        self.logtimings()
+
+    def begin(self):
+        if self.transaction is None:
+            self.transaction = database.transaction()
+            self.transaction.__enter__()
+
+    def commit(self):
+        if self.transaction is None:
+            return
+        start = time.time()
+        self.transaction.__exit__(None, None, None)
+        latency = time.time() - start
+        for name in self.pending:
+            self.timings[name]['commit'] = latency
+        self.transaction = None
+        self.pending = []
+
+    def run(self, name, func, *args, **kwds):
+        """Call `func` under a savepoint in the current batch.  None if it failed."""
+        rows_in = kwds.pop('rows_in', None)
+        self.begin()
+        start, cpu = time.time(), cputime()
+        try:
+            with database.savepoint():
+                result = func(*args, **kwds)
+        except Exception as e:
+            db_logger.error("{}: '{}' rolled back: {}".format(self.formadv, name, e))
+            self.failed.append(name)
+            return
+
+        elapsed = time.time() - start
+        if self.report is not None:
+            self.report.add(name, elapsed, cputime() - cpu, rows_in, result)
+        self.timings[name] = {'rows' : result, 'insert' : elapsed, 'commit' : None}
+        self.pending.append(name)
+        if len(self.pending) >= self.batchsize:
+            self.commit()
+        return result
+
+    def insert(self, table, data, **kwds):
+        """`table.insertdf(data)` plus its manifest row, unless the manifest has it already."""
+        if table._meta.db_table in self.done:
+            return
+
+        def load():
+            imported = table.insertdf(data, **kwds) if len(data) else 0
+            LoadManifest.record(self.formadv, self.checksum, table, len(data), imported,
+                stat = self.stat)
+            return imported
+        return self.run(table._meta.db_table, load, rows_in = len(data))
+
+    def logtimings(self):
+        for name, t in self.timings.items():
+            db_logger.info("{}: '{}' {} rows, insert {:.2f}s, commit {:.2f}s".format(
+                self.formadv, name, t['rows'], t['insert'], t['commit'] or 0))
+        if self.failed:
+            db_logger.warning("{}: failed tables {}".format(self.formadv, ', '.join(self.failed)))
+
 class Adviser(AdvBaseModel):
     crd = IntegerField(null = False, constraints = [Check('crd > 0')], index = True, primary_key = True)
     secnumber = CharField(max_length = 15)
@@ -97,22 +598,45 @@ class Adviser(AdvBaseModel):
     class Meta:
         db_table = 'advisers'
 
-    @classmethod
-    def insertdf(cls, df, extrafields = ['crd'], **kwds):
-        fromdb = cls.to_dataframe(cls.select(cls.crd, cls.secnumber, cls.name))
-        if not fromdb.empty:
-            namechanges = df.loc[
-                (df.crd.isin(fromdb.crd)) & ~(df.name.replace(',', '').isin(fromdb.name.replace(',', '')))
-                    ].ix[:, ['crd', 'secnumber', 'name', 'legalname']]
+    @staticmethod
+    def namehash(names):
+        return hash_array(names.fillna('').str.replace(',', '').values.astype(object))
 
-            oldnames = fromdb.loc[
-                fromdb.crd.isin(namechanges.crd)
-                    ].rename(columns = {'crd' : 'adviser'})
+    @classmethod
+    def namechanges(cls, df, chunksize = 5000):
+        """Rows on file for the advisers in `df` whose name (commas aside) has changed.
+
+        Names are compared by hash, one chunk of CRDs at a time, so only the
+        advisers being loaded are ever pulled from the table.
+        """
+        incoming = pd.Series(cls.namehash(df.name), index = df.crd.values)
+        incoming = incoming.loc[~incoming.index.duplicated(keep = 'last')]
+        crds = incoming.index.tolist()
+        changes = []
+        for i in range(0, len(crds), chunksize):
+            fromdb = cls.to_dataframe(cls.select(cls.crd, cls.secnumber, cls.name)
+                .where(cls.crd << crds[i:i + chunksize]))
+            if fromdb.empty:
+                continue
+            changed = cls.namehash(fromdb.name) != incoming.reindex(fromdb.crd).values
+            changes.append(fromdb.loc[changed])
 
-            for change in namechanges.to_dict(orient = 'records'):
-                cls.update(**change).where(cls.crd == change['crd']).execute()
+        if not changes:
+            return pd.DataFrame(columns = ['crd', 'secnumber', 'name'])
+        return pd.concat(changes)
 
-            AlternateName.insertdf(oldnames)
+    @classmethod
+    def insertdf(cls, df, extrafields = ['crd'], **kwds):
+        oldnames = cls.namechanges(df)
+        if not oldnames.empty:
+            namechanges = df.loc[df.crd.isin(oldnames.crd)]\
+                .drop_duplicates(subset = ['crd'], keep = 'last')\
+                .ix[:, ['crd', 'secnumber', 'name', 'legalname']]
+
+            with database.atomic():
+                bulkupdate(cls, namechanges.to_dict(orient = 'records'),
+                    ['secnumber', 'name', 'legalname'])
+                AlternateName.insertdf(oldnames.rename(columns = {'crd' : 'adviser'}))
             df = df.loc[~df.crd.isin(namechanges.crd)]
 
         return super(Adviser, cls).insertdf(df,
@@ -150,23 +674,9 @@ class Filing(AdvBaseModel):
 
     @classmethod
     def mostrecent(cls):
-        alias = cls.alias()
-        subquery = (alias.select( #Subquery to get max filing per adviser.
-            alias.adviser,
-            fn.MAX(alias.id).alias('most_recent'))
-            .group_by(alias.adviser)
-            .alias('most_recent_subquery'))
-
-        mostrecent = (
-            cls.select(cls.id.alias("filing_id"), Adviser.crd)
-            .join(Adviser)
-            .switch(cls)
-            .join(subquery, on=(
-                (cls.id == subquery.c.most_recent) &
-                (cls.adviser == subquery.c.adviser_id)))
-                    )
-
-        return cls.to_dataframe(mostrecent)
+        return cls.to_dataframe(LatestFiling.select(
+            LatestFiling.filing.alias("filing_id"),
+            LatestFiling.adviser.alias("crd")))
 
     @classmethod
     def getdict(cls, formadv):
@@ -174,6 +684,86 @@ class Filing(AdvBaseModel):
             .where(cls.formadv == formadv.id))
         return {row['adviser'] : row['id'] for row in rows}
 
+class LatestFiling(BaseModel):
+    """Most recent filing per adviser, kept current by `refresh` after each load."""
+    adviser = ForeignKeyField(Adviser, primary_key = True, related_name = 'latest_filing')
+    filing = ForeignKeyField(Filing)
+    formadv = ForeignKeyField(FormADV)
+
+    class Meta:
+        db_table = 'latest_filing'
+
+    @classmethod
+    def refresh(cls, formadv = None):
+        """Recompute the latest filing of the advisers filed in `formadv` (all advisers if None)."""
+        latest = (Filing.select(fn.MAX(Filing.id))
+            .group_by(Filing.adviser)
+            .order_by())
+
+        touched = None
+        if formadv is not None:
+            touched = Filing.select(Filing.adviser).where(Filing.formadv == formadv.id)
+            latest = latest.where(Filing.adviser << touched)
+
+        rows = (Filing.select(Filing.adviser, Filing.id.alias('filing'), Filing.formadv)
+            .where(Filing.id << latest)
+            .order_by()
+            .dicts())
+
+        with database.atomic():
+            query = cls.delete()
+            if touched is not None:
+                query = query.where(cls.adviser << touched)
+            query.execute()
+            return bulkinsert(cls, rows)
+
+class FirmHash(BaseModel):
+    """Hash of each adviser's last loaded daily-feed record, for delta loads."""
+    adviser = ForeignKeyField(Adviser, primary_key = True, related_name = 'firmhash')
+    rowhash = CharField(max_length = 16)
+    date = DateField()
+
+    class Meta:
+        db_table = 'firm_hashes'
+
+    IGNORED = ['formadv', 'date', 'filing', 'rowhash']
+
+    @classmethod
+    def rowhashes(cls, df):
+        """One hex digest per row of `df`, independent of column order and of
+        the per-load columns in `IGNORED`."""
+        columns = sorted(c for c in df.columns if c not in cls.IGNORED)
+        return pd.Series(['{:016x}'.format(int(h)) for h in
+            hash_pandas_object(df[columns], index = False).values], index = df.index)
+
+    @classmethod
+    def stored(cls, crds, chunksize = 500):
+        crds = list(set(native(v) for v in crds))
+        hashes = {}
+        for i in range(0, len(crds), chunksize):
+            hashes.update(cls.select(cls.adviser, cls.rowhash)
+                .where(cls.adviser << crds[i:i + chunksize]).tuples())
+        return hashes
+
+    @classmethod
+    def changed(cls, df):
+        """Mask of the rows of `df` (which needs a `rowhash` column) that are new or changed."""
+        return df.rowhash != df.crd.map(cls.stored(df.crd))
+
+    @classmethod
+    def store(cls, df, date, chunksize = 500):
+        rows = df.ix[:, ['crd', 'rowhash']]\
+            .drop_duplicates(subset = ['crd'], keep = 'last')\
+            .rename(columns = {'crd' : 'adviser'})\
+            .assign(date = date)\
+            .to_dict(orient = 'records')
+
+        crds = [row['adviser'] for row in nativerows(rows)]
+        with database.atomic():
+            for i in range(0, len(crds), chunksize):
+                cls.delete().where(cls.adviser << crds[i:i + chunksize]).execute()
+            return bulkinsert(cls, rows)
+
 class SecFiler(AdvBaseModel):
     adviser = ForeignKeyField(Adviser, primary_key = True, related_name = 'secfilers')
     cik = IntegerField()
@@ -217,50 +807,61 @@ class Person(AdvBaseModel):
         return super(Person, cls).insertdf(df,
             extrafields = extrafields, **kwds)
 
+    @staticmethod
+    def titlecase(title):
+        return ' '.join(x.capitalize() for x in title.split())
+
     @classmethod
     def addpeople(cls, crd, people):
+        return cls.addpeople_batch({crd : people})
+
+    @classmethod
+    def addpeople_batch(cls, peoplemap):
+        """Upsert people and ownership for many advisers at once.
+
+        `peoplemap` maps crd -> list of scraped person dicts.  Returns the
+        people frame with the resolved `id` of each person.
+        """
+        people = pd.DataFrame([mergedicts(person, adviser = int(crd))
+            for crd, rows in peoplemap.items() for person in rows])
+
+        if people.empty or not hasattr(people, 'name'):
+            return people
+
+        for field in ('title', 'ownership', 'since', 'controlperson'):
+            if field not in people:
+                people[field] = np.nan
+
+        names = people.name.to_name()
+        since = pd.to_datetime(people.since, errors = 'coerce')
+        people = people.assign(
+            firstname = names.firstname,
+            lastname = names.lastname,
+            title = people.title.fillna('n/a').quickmap(cls.titlecase),
+            date = since.dt.date.astype(object).where(since.notnull(), None),
+            percentowned = pd.to_numeric(people.ownership.fillna('0')\
+                .astype(str).str.replace(re_PERCENTAGE, r'.\1'),
+                    errors = 'coerce').fillna(0),
+            controlperson = people.controlperson.fillna(False).astype(bool)
+                ).drop_duplicates(subset = ['adviser', 'firstname', 'lastname'])
+
+        fields = ['adviser', 'firstname', 'lastname', 'title', 'date']
+        table = InternTable(cls, fields[:3]).loadin('adviser', people.adviser)
+        records = people[fields].to_dict(orient = 'records')
+        onfile = [table.getkey(row) in table for row in records]
         with database.atomic():
-            for person in people:
-                row = mergedicts(getname(person['name']), adviser = crd)
-                while True:
-                    try:
-                        entry = cls.get(**row); break
-                    except cls.DoesNotExist:
-                        cls.insert(**row).execute()
-
-                try:
-                    percentage = re_PERCENTAGE.sub(r'.\1', person['ownership'])
-                except KeyError:
-                    percentage = '0'
-
-                is_cntrlperson = person['controlperson']
-                try:
-                    Ownership.get_or_create(person = entry,
-                        percentowned = percentage,
-                        controlperson = is_cntrlperson)
-                except IntegrityError as e:
-                    db_logger.error(e)
-
-                try:
-                    title = ' '.join(x.capitalize() for x in person['title'].split())
-                except KeyError:
-                    title = 'n/a'
-
-                try:
-                    title = ' '.join(x.capitalize() for x in person['title'].split())
-                except KeyError:
-                    title = 'n/a'
-
-                try:
-                    since = pd.to_datetime(person['since'])
-                except (KeyError, Exception) as e:
-                    db_logger.error(e)
-                    since = None
-
-                (cls.update(date = since, title = title)
-                    .where((cls.firstname == entry.firstname) &
-                        (cls.lastname == entry.lastname) &
-                        (cls.adviser == crd)).execute())
+            keys = [table.intern(row) for row in records]
+            table.flush()
+            people['id'] = [table[key] for key in keys]
+            bulkupdate(cls, people.loc[onfile, ['id', 'title', 'date']]\
+                .to_dict(orient = 'records'), ['title', 'date'])
+
+            owned = existing(Ownership.person, people.id)
+            bulkinsert(Ownership, people.loc[~people.id.isin(owned)]\
+                .rename(columns = {'id' : 'person'})\
+                .ix[:, ['person', 'percentowned', 'controlperson']]\
+                .to_dict(orient = 'records'))
+        return people
 
 class Ownership(BaseModel):
     person = ForeignKeyField(Person, primary_key = True)
@@ -332,6 +933,39 @@ class Description(BaseModel):
     def textdict(cls):
         return cls.getdict('text', reversed = True)
 
+    @classmethod
+    def registry(cls):
+        global _descriptions
+        if _descriptions is None:
+            _descriptions = DescriptionRegistry().load()
+        return _descriptions
+
+class DescriptionRegistry(InternTable):
+    """Process-wide text -> id map for `Description`.  Loaded once; `add`
+    inserts only texts it has not seen and extends the map with their ids.
+    Texts are matched case-insensitively, as the unique index on `text` does."""
+    def __init__(self):
+        super(DescriptionRegistry, self).__init__(Description, ['text'],
+            casefold = True, ignore = True)
+        self.textids = {}
+
+    def load(self, where = None):
+        super(DescriptionRegistry, self).load(where = where)
+        self.textids = {key[0] : id for key, id in self.ids.items()}
+        return self
+
+    def add(self, descriptions):
+        for row in descriptions:
+            self.intern(row)
+        return self.flush()
+
+    def getids(self, texts):
+        ids = {text : self.textids.get(self.keyvalue('text', text))
+            for text in texts.dropna().unique()}
+        return texts.map(ids)
+
+_descriptions = None
+
 class ClientType(AdvBaseModel):
     description = ForeignKeyField(Description, related_name = 'client_types')
     filing = ForeignKeyField(Filing, related_name = 'client_types')
@@ -374,29 +1008,55 @@ class Courtcase(AdvBaseModel):
     class Meta:
         db_table = 'courtcases'
 
+    @staticmethod
+    def nonblank(series):
+        return series.replace(r'^\s*$', np.nan, regex = True)
+
     @classmethod
     def addcases(cls, crd, disclosures):
-        for case in disclosures:
-            fine = case['renderedfine']
-            if not fine:
-                fine = case['amendedfine']
-                if not fine:
-                    _search = re_DOLLARAMT.search(str(case['sanctions']))
-                    if _search:
-                        fine = _search.group(1)
-            row = mergedicts({
-                k : (floating_point(fine) if k == 'renderedfine'
-                    else pd.to_datetime(v) if k == 'date' else v)
-                    for k, v in case.items() if k in cls._meta.fields
-                        }, adviser = crd)
-
-            entry = cls.get_or_create(**row)[0]
-            if case['allegation']:
-                try:
-                    Allegation.get_or_create(case = entry.id,
-                        allegation = re_ALLEGATION.sub(r'\1', case['allegation']))
-                except IntegrityError:
-                    pass
+        return cls.addcases_batch({crd : disclosures})
+
+    @classmethod
+    def addcases_batch(cls, casemap):
+        """Insert regulatory DRPs and their allegations for many advisers at once.
+
+        `casemap` maps crd -> list of scraped DRP dicts.  Cases already on file
+        are matched on every column, compared as stored, and left alone.
+        """
+        cases = pd.DataFrame([mergedicts(case, adviser = int(crd))
+            for crd, rows in casemap.items() for case in rows])
+
+        if cases.empty:
+            return cases
+
+        fields = ['adviser', 'number', 'district', 'resolution', 'renderedfine', 'sanctions', 'date']
+        for field in fields + ['amendedfine', 'allegation']:
+            if field not in cases:
+                cases[field] = np.nan
+
+        fine = cls.nonblank(cases.renderedfine)\
+            .fillna(cls.nonblank(cases.amendedfine))\
+            .fillna(cases.sanctions.astype(str).str.extract(re_DOLLARAMT, expand = False))
+
+        date = pd.to_datetime(cases.date, errors = 'coerce')
+        cases = cases.assign(
+            renderedfine = pd.to_numeric(fine.astype(str)\
+                .str.replace(r'[^\d\.]', '', regex = True), errors = 'coerce'),
+            date = date.dt.date.astype(object).where(date.notnull(), None),
+            allegation = cls.nonblank(cases.allegation).dropna()\
+                .astype(object).str.replace(re_ALLEGATION, r'\1'))
+
+        table = InternTable(cls, fields, casefold = True).loadin('adviser', cases.adviser)
+        with database.atomic():
+            keys = [table.intern(row) for row in cases[fields].to_dict(orient = 'records')]
+            table.flush()
+            cases['id'] = [table[key] for key in keys]
+            alleged = cases.loc[cases.allegation.notnull()].drop_duplicates(subset = ['id'])
+            bulkinsert(Allegation, alleged.loc[~alleged.id.isin(existing(Allegation.case, alleged.id))]\
+                .rename(columns = {'id' : 'case'})\
+                .ix[:, ['case', 'allegation']]\
+                .to_dict(orient = 'records'))
+        return cases
 
 class Allegation(BaseModel):
     case = ForeignKeyField(Courtcase, primary_key = True)
@@ -421,7 +1081,7 @@ class PrivateFund(AdvBaseModel):
                 )
 
     @classmethod
-    def addfund(cls, crd, fund):
+    def fundrow(cls, crd, fund):
         info = fund['fundinfo']
         _ = fund['fund_id']
         aum = info['assetsundermgmt']
@@ -432,8 +1092,15 @@ class PrivateFund(AdvBaseModel):
             k : (v if k != 'assetsundermgmt' else floating_point(aum))
                 for k, v in info.items() if k in cls._meta.fields
                     }, type = info['fundtype'], fund_id = "{}-{}".format(_[0:3], _[3:]),
-                        adviser_id = crd, name = fund['name'])
+                        adviser = crd, name = fund['name'])
+
+        if row.get('dated'):
+            row['dated'] = pd.to_datetime(row['dated']).date()
+        return row
 
+    @classmethod
+    def addfund(cls, crd, fund):
+        row = cls.fundrow(crd, fund)
         try:
             entry = cls.get_or_create(**row)
         except IntegrityError as e:
@@ -441,6 +1108,23 @@ class PrivateFund(AdvBaseModel):
             return cls.get(adviser = crd, fund_id = row['fund_id'])
         return entry[0]
 
+    @classmethod
+    def addfunds(cls, fundmap):
+        """Resolve the ids of the funds of many advisers, inserting the new ones in one batch.
+
+        `fundmap` maps crd -> list of scraped funds.  Returns an `InternTable`
+        keyed on (adviser, fund_id, dated).
+        """
+        table = InternTable(cls, ['adviser', 'fund_id', 'dated'])
+        table.loadin('adviser', fundmap.keys())
+        with database.atomic():
+            for crd, funds in fundmap.items():
+                for fund in funds:
+                    if 'businesses' in fund:
+                        table.intern(cls.fundrow(crd, fund))
+            table.flush()
+        return table
+
 class OtherBusiness(BaseModel):
     name = CharField(max_length = 255, null = False)
     type = CharField(max_length = 150, null = False)
@@ -452,16 +1136,47 @@ class OtherBusiness(BaseModel):
             (('name', 'type', 'info'), True),
                 )
 
+    @staticmethod
+    def cleanrow(businessrow):
+        if re_NOTBUSINESS.search(businessrow['name']):
+            return
+        info = re_BUSINESSINFO.search(businessrow['info']).group(1).upper()
+        return mergedicts(businessrow, info = info)
+
     @classmethod
     def create_relationship(cls, row, businessrow):
-        if re_NOTBUSINESS.search(businessrow['name']):
+        businessrow = cls.cleanrow(businessrow)
+        if not businessrow:
             return
 
-        info = businessrow['info']
-        businessrow['info'] = re_BUSINESSINFO.search(info).group(1).upper()
         entry, created = cls.get_or_create(**businessrow)
         return mergedicts(row, business = entry.id)
 
+class BusinessRegistry(InternTable):
+    """Interned `OtherBusiness` ids and the relationship rows waiting on them.
+
+    The same auditors, custodians and prime brokers turn up across thousands
+    of advisers, so `load` the whole table once per run, `relate` rows as they
+    come and `flush` at batch boundaries.
+    """
+    def __init__(self):
+        super(BusinessRegistry, self).__init__(OtherBusiness, ['name', 'type', 'info'],
+            casefold = True, ignore = True)
+        self.relations = defaultdict(list)
+
+    def relate(self, model, row, businessrow):
+        businessrow = OtherBusiness.cleanrow(businessrow)
+        if businessrow:
+            self.relations[model].append((row, self.intern(businessrow)))
+
+    def flush(self):
+        inserted = super(BusinessRegistry, self).flush()
+        for model, relations in self.relations.items():
+            model.tryinsert([mergedicts(row, business = self[key])
+                for row, key in relations])
+        self.relations.clear()
+        return inserted
+
 class AdviserRelation(AdvBaseModel):
     business = ForeignKeyField(OtherBusiness)
     adviser = ForeignKeyField(Adviser)
@@ -473,14 +1188,13 @@ class AdviserRelation(AdvBaseModel):
                 )
 
     @classmethod
-    def create_relationships(cls, crd, businesses):
-        relationships = []
+    def create_relationships(cls, crd, businesses, registry = None):
+        pending = registry or BusinessRegistry()
         for businessrow in businesses:
-            relationship = OtherBusiness.create_relationship({'adviser' : crd}, businessrow)
-            if not relationship:
-                continue
-            relationships.append(relationship)
-        cls.tryinsert(relationships)
+            pending.relate(cls, {'adviser' : crd}, businessrow)
+
+        if registry is None:
+            pending.flush()
 
 class FundRelation(BaseModel):
     business = ForeignKeyField(OtherBusiness)
@@ -493,20 +1207,20 @@ class FundRelation(BaseModel):
                 )
 
     @classmethod
-    def create_relationships(cls, crd, funds):
-        relationships = []
+    def create_relationships(cls, crd, funds, fundids = None, registry = None):
+        if fundids is None:
+            fundids = PrivateFund.addfunds({crd : funds})
+
+        pending = registry or BusinessRegistry()
         for fund in funds:
             if 'businesses' not in fund:
                 continue
 
-            businesses = fund['businesses']
-            for businessrow in businesses:
-                dbfund = PrivateFund.addfund(crd, fund)
-                relationship = OtherBusiness.create_relationship(
-                    {'privatefund' : dbfund.id}, businessrow)
-                relationships.append(relationship)
+            fundid = fundids[fundids.getkey(PrivateFund.fundrow(crd, fund))]
+            for businessrow in fund['businesses']:
+                pending.relate(cls, {'privatefund' : fundid}, businessrow)
 
-        if relationships:
-            cls.tryinsert(relationships)
+        if registry is None:
+            pending.flush()
 
 setup()
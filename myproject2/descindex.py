@@ -0,0 +1,63 @@
+"""Inverted index of the desc tables for the filter menu.
+
+Every (table, desc, value) maps to the sorted, unique CRDs holding that answer
+and to the positions of its rows, so a multi-criteria filter is a few set
+operations on small integer arrays rather than a masked scan of the table per
+criterion.
+"""
+from functools import reduce
+import numpy as np
+
+EMPTY = np.array([], dtype = np.int64)
+
+class DescIndex(object):
+    def __init__(self, desctables):
+        self.postings = {}
+        self.positions = {}
+        self.buckets = {}
+        for table, df in desctables.items():
+            self.add(table, df)
+
+    def add(self, table, df):
+        df = df[['desc', 'value', 'crd']]
+        pos = np.flatnonzero(df.notnull().all(axis = 1).values)
+        desc, value, crd = [df[c].values[pos].astype(np.int64) for c in ('desc', 'value', 'crd')]
+        order = np.lexsort((crd, value, desc))
+        desc, value, crd, pos = desc[order], value[order], crd[order], pos[order]
+
+        breaks = np.flatnonzero((np.diff(desc) != 0) | (np.diff(value) != 0)) + 1
+        starts = np.concatenate(([0], breaks)) if len(crd) else EMPTY
+        stops = np.append(starts[1:], len(crd))
+        for start, stop in zip(starts, stops):
+            key = (desc[start], value[start])
+            self.postings[(table,) + key] = np.unique(crd[start:stop])
+            self.positions[(table,) + key] = np.sort(pos[start:stop])
+            self.buckets.setdefault((table, key[0]), []).append(key[1])
+
+    def gather(self, mapping, table, desc, value, atleast):
+        if not atleast:
+            return mapping.get((table, desc, value), EMPTY)
+
+        found = [mapping[(table, desc, v)]
+            for v in self.buckets.get((table, desc), []) if v >= value]
+        if not found:
+            return EMPTY
+        return np.unique(np.concatenate(found))
+
+    def lookup(self, table, desc, value, atleast = False):
+        """CRDs answering `value` to `desc`, or any bucket >= `value` if `atleast`."""
+        return self.gather(self.postings, table, desc, value, atleast)
+
+    def rows(self, table, desc, value, atleast = False):
+        """Sorted positions of the rows of `table` behind `lookup`, for `iloc`."""
+        return self.gather(self.positions, table, desc, value, atleast)
+
+    def query(self, table, desc2rank, how = 'and', atleast = False):
+        """Sorted CRDs matching all (`how` = 'and') or any ('or') of `desc2rank`."""
+        found = [self.lookup(table, int(desc), int(rank), atleast = atleast)
+            for desc, rank in desc2rank.items()]
+        if not found:
+            return EMPTY
+        if how == 'and':
+            return reduce(lambda a, b: np.intersect1d(a, b, assume_unique = True), found)
+        return reduce(np.union1d, found)
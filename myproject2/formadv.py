@@ -2,6 +2,10 @@ import re
 import shutil
 
 from adviserinfo import *
+from headercache import HEADERS
+from lookup import CategoryLookup, matchcategories
+import snapshot
+from profilecache import bumpversion
 
 FIELDS_PATH = os.path.join(settings.CONFIGDIR, 'fields_map', 'advfiling_fields_map.json')
 
@@ -35,7 +39,11 @@ NUMERIC_RANKINGS = {
     "More than 1000": 1001,
 		}
 
+PERCENT_LOOKUP = CategoryLookup(PERCENT_RANKINGS, 'PERCENT_RANKINGS', ignore = r'^(?:True|False|nan|[\d\.]+)$')
+NUMERIC_LOOKUP = CategoryLookup(NUMERIC_RANKINGS, 'NUMERIC_RANKINGS', ignore = r'^[\d\.]+$')
+
 re_TENDIGITS = re.compile(r'^\d{10}$')
+re_MORECLIENTS = re.compile('more.*?(?:100|500)', re.I)
 phoneformat = "({}) {}-{}".format
 usdformat = '${:,.2f}'.format
 
@@ -43,6 +51,29 @@ def get_aumdiff(df1, df2):
     aumdict = df2.get_mapper('crd', 'assetsundermgmt')
     return df1.assetsundermgmt - df1.crd.quickmap(aumdict)
 
+def rankfilings(filings):
+    """Newest and previous filing of each crd in `filings` (id, crd, formadv_id),
+    from one scan of the rows sorted by crd, newest formadv_id (then id) first."""
+    crd, formadv_id, ids = [filings[c].values.astype(np.int64) for c in ('crd', 'formadv_id', 'id')]
+    order = np.lexsort((-ids, -formadv_id, crd))
+    crd, formadv_id, ids = crd[order], formadv_id[order], ids[order]
+
+    starts = np.flatnonzero(np.r_[True, crd[1:] != crd[:-1]]) if len(crd) else np.array([], dtype = int)
+    hasprev = np.append(starts[1:], len(crd)) - starts > 1
+    prev = np.minimum(starts + 1, max(len(crd) - 1, 0))
+    return pd.DataFrame({
+        'crd' : crd[starts],
+        'id' : ids[starts],
+        'formadv_id' : formadv_id[starts],
+        'prev_id' : pd.Series(ids[prev], dtype = object).where(hasprev, None).values,
+        'prev_formadv_id' : pd.Series(formadv_id[prev], dtype = object).where(hasprev, None).values,
+            }, columns = ['crd', 'id', 'formadv_id', 'prev_id', 'prev_formadv_id'])
+
+def sqlvalues(rows):
+    """`(1, 2, NULL), (...)` for rows of integers or None."""
+    fmt = lambda v: 'NULL' if v is None else str(int(v))
+    return ', '.join('(%s)' % ', '.join(fmt(v) for v in row) for row in rows)
+
 def to_phone(series):
     series_copy = series.str.replace(r'\(|\)|-|\.| |\/', '')
     return series_copy.modify(
@@ -63,6 +94,10 @@ class AdvFiling(StageTable):
     LISTDIR = mkdir(settings.BASEDIR, 'lists')
     COMPANYLIST_PATH = mkpath(LISTDIR, 'companylist.csv')
     PREVIOUSQTR_PATH = mkpath(LISTDIR, 'previousqtr.csv')
+    SNAPSHOTDIR = mkdir(LISTDIR, 'snapshot')
+    VERSION_PATH = mkpath(LISTDIR, 'version')
+    REPLACE_ROWS = 1000
+    NUMERICFIELDS = ['crd', 'formadv_id', 'assetsundermgmt', 'numberofaccts', 'numberofclients', 'numberofemployees']
 
     def __init__(self, path, fields_path = FIELDS_PATH, table = 'advfiling', **kwds):
         super(AdvFiling, self).__init__(path, fields_path = fields_path, table = table, **kwds)
@@ -96,9 +131,28 @@ class AdvFiling(StageTable):
                     )), fa.table)
     @classmethod
     @dbfunc(IapdDB)
+    def refresh_latest(cls, formadv_id, db):
+        """Point `latest_advfiling` at the newest and previous filing of each adviser in `formadv_id` (all advisers if None)."""
+        touched = ''
+        if formadv_id is not None:
+            touched = "where crd in (select crd from advfiling where formadv_id = %s)" % formadv_id
+
+        latest = rankfilings(db.select('advfiling',
+            fields = ['id', 'crd', 'formadv_id'],
+            subquery = touched))
+
+        #each replace swaps whole rows atomically, so readers never see an adviser missing
+        rows = list(latest.itertuples(index = False))
+        for i in range(0, len(rows), cls.REPLACE_ROWS):
+            db.affectrows("replace into latest_advfiling (%s) values %s" % (
+                ', '.join(latest.columns), sqlvalues(rows[i:i + cls.REPLACE_ROWS])))
+        return len(latest)
+
+    @classmethod
+    @dbfunc(IapdDB)
     def get_companylist(cls, db):
-        return db.select_grouped_aggregate('advfiling',
-            'crd','formadv_id')\
+        return db.select('advfiling',
+            subquery = "where id in (select id from latest_advfiling)")\
                 .fillna('')\
                 .apply(lambda x: x.to_ascii()\
                 .astype(str)
@@ -107,31 +161,15 @@ class AdvFiling(StageTable):
     @classmethod
     @dbfunc(IapdDB)
     def store_most_recent_filings(cls, db):
+        """Write each adviser's newest filing, with `aumdiff` against its previous
+        one, to companylist.csv and the previous filings to previousqtr.csv, both
+        read by the ids `refresh_latest` keeps in `latest_advfiling`."""
         data = cls.get_companylist()
         data = data.assign(fax = data.fax.to_phone(), phone = data.phone.to_phone())
-        max_ids = map(str, data.id)
-        other_ids = db.select('advfiling',
-            fields = ['id', 'crd', 'formadv_id'],
-            subquery = "where id not in (%s)" % ', '.join(max_ids)
-                )
-
-        tings = other_ids\
-            .groupby(['crd'], as_index = False)\
-            .agg({'formadv_id' : 'max'})
-
-        dflist = []
-        tg = tings.groupby('formadv_id')
-        fg = other_ids.groupby('formadv_id')
-        for f_id, group in tg:
-            df = fg.get_group(f_id)
-            dflist.append(df.loc[df.crd.isin(group.crd)])
-    
-        ids = pd.concat(dflist).id
         dataprev = db.select('advfiling',
-            subquery = "where id in (%s)" % ', '.join(map(str, ids))
-                )
+            subquery = "where id in (select prev_id from latest_advfiling)")
         dataprev = dataprev.assign(fax = dataprev.fax.to_phone(), phone = dataprev.phone.to_phone())
-        
+
         results_to_csv(cls.COMPANYLIST_PATH,
             data.assign(aumdiff = get_aumdiff(data, dataprev),
                 company = data.company.str.strip('"'))\
@@ -150,19 +188,46 @@ class AdvFiling(StageTable):
             else:
                 results_to_csv(outfile, db.select(table))
 
+    @classmethod
+    @dbfunc(IapdDB)
+    def store_snapshot(cls, db):
+        """Snapshot everything the web pages read (company lists, desc tables,
+        numeric history of all filings, description and filing date maps) for
+        `helpers.DataContext`.  Desc tables and numeric history are stored
+        sorted by crd so profiles are contiguous slices."""
+        formadvs = db.formadv().records
+        bycrd = lambda df: df.sort_values('crd', kind = 'mergesort')
+        frames = {
+            'companylist' : pd.read_csv(cls.COMPANYLIST_PATH).sort_values(
+                ['aumdiff', 'assetsundermgmt'], ascending = [1, 0]),
+            'previousqtr' : pd.read_csv(cls.PREVIOUSQTR_PATH),
+            'numeric' : bycrd(db.select('advfiling', fields = cls.NUMERICFIELDS)),
+                }
+
+        for table in db.desctables:
+            frames['desc_' + table] = bycrd(pd.read_csv(OSPath.join(cls.LISTDIR, table + ".csv")))
+
+        path = snapshot.write(cls.SNAPSHOTDIR, frames, meta = {
+            'descmap' : db.description_map,
+            'datemap' : formadvs.get_mapper('id', 'filingdate'),
+            'formadv_ids' : list(formadvs.id),
+                })
+        bumpversion(cls.VERSION_PATH) #the only bump: readers never see a version without its snapshot
+        return path
+
     @classmethod
     @dbfunc(IapdDB)
     def process_formadvs(cls, db):
         entries = db.select('formadv',
             subquery = 'where rows_original is NULL')
 
+        descmap = db.description_map
         for row in entries.itertuples():
             self = cls(mkpath(cls.EXTRACTDIR, row.filename))
             for df in self:
                 df['formadv_id'] = row.id
                 self.write(df)
 
-            descmap = db.description_map
             for k, v in self.descriptions.items():
                 v['formadv_id'] = row.id
                 v['desc'] = v.desc\
@@ -178,10 +243,11 @@ class AdvFiling(StageTable):
                 if not newdesc.empty:
                     db.insert(newdesc.assign(id = np.nan)\
                         .ix[:, ['id', 'desc', 'type']], 'descriptions')
+                    descmap = db.description_map
 
                 descfile = OSPath.join(cls.DESCDIR, "%s_%s.csv" % (row.id, k))
                 results_to_csv(descfile, v.loc[v.value > 0]\
-                    .assign(desc = v.desc.quickmap(db.description_map)))
+                    .assign(desc = v.desc.quickmap(descmap)))
 
                 if k != 'advisory_activities':
                     db.load_csv(descfile, k)
@@ -195,6 +261,7 @@ class AdvFiling(StageTable):
 
         cls.store_most_recent_filings()
         cls.store_descdata()
+        cls.store_snapshot()
 
     @classmethod
     @dbfunc(IapdDB)
@@ -205,6 +272,7 @@ class AdvFiling(StageTable):
             % (rows_imported, row.id)
 
         db.affectrows(q)
+        cls.refresh_latest(row.id)
         shutil.move(outfile, cls.IMPORTED)
     
     @staticmethod
@@ -216,11 +284,10 @@ class AdvFiling(StageTable):
     @staticmethod
     def get_numclients(df):
         if not df.filter(regex = 'numberofclients').empty:
-            return df.numberofclients\
-                .modify(df.numberofclients.contains(re.compile(
-                    'more.*?(?:100|500)', re.I)), np.nan)\
-                .fillna(df.numberofclients_specify)\
-                .quickmap(PERCENT_RANKINGS)\
+            data = df.numberofclients
+            return PERCENT_LOOKUP(data\
+                .where(~matchcategories(data, re_MORECLIENTS))\
+                .fillna(df.numberofclients_specify))\
                 .to_numeric()
 
     @staticmethod
@@ -261,7 +328,7 @@ class AdvFiling(StageTable):
                         .astype(str)\
                         .replace({'^Y$' : True,'^N$' : False},
                             regex = True)\
-                        .quickmap(PERCENT_RANKINGS)\
+                        .pipe(PERCENT_LOOKUP)\
                         .to_numeric()
                             ).ix[:,['crd', 'desc', 'value']].dropna()
 
@@ -277,12 +344,21 @@ class AdvFiling(StageTable):
             self.store_companylist()
         return pd.read_csv(self.COMPANYLIST_PATH)
 
+    def headerplan(self, df):
+        plan = HEADERS.get(df.columns, self.fields_map)
+        if plan is None:
+            plan = HEADERS.store(df.columns, self.fields_map,
+                columns = list(df.rename(columns = self.fields_map).mangle_cols().columns),
+                dups = list(df.dup_cols()))
+        return plan
+
     def normalize(self, df, *args, **kwds):
-        df = df.rename(columns = self.fields_map)\
-            .mangle_cols()\
-            .assign(**{
-                k : df.combine_dup_cols(k) for k in df.dup_cols()
-                    })
+        plan = self.headerplan(df)
+        renamed = df.copy(deep = False)
+        renamed.columns = plan['columns']
+        df = renamed.assign(**{
+            k : df.combine_dup_cols(k) for k in plan['dups']
+                })
 
         self.descriptions = self.get_checkbox_answers(df)
         df = super(AdvFiling, self).normalize(
@@ -294,7 +370,7 @@ class AdvFiling(StageTable):
             df['fax'] = df['fax'].to_phone()
 
         try:
-            df['numberofemployees'] = df.numberofemployees.quickmap(NUMERIC_RANKINGS)
+            df['numberofemployees'] = NUMERIC_LOOKUP(df.numberofemployees)
         except KeyError:
             pass
         return df
@@ -308,12 +384,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--update', action = 'store_true', default = False)
     parser.add_argument('--load', action = 'store_true', default = False)
+    parser.add_argument('--snapshot', action = 'store_true', default = False)
     
     args = parser.parse_args()
     if args.update:
+        AdvFiling.refresh_latest(None)
         AdvFiling.store_most_recent_filings()
         AdvFiling.store_descdata()
+        AdvFiling.store_snapshot()
     elif args.load:
         AdvFiling.process_formadvs()
+    elif args.snapshot:
+        AdvFiling.store_snapshot()
         
     
\ No newline at end of file
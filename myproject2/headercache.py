@@ -0,0 +1,52 @@
+"""Plans for known Form ADV header layouts, persisted by header signature.
+
+SEC files reuse a handful of header layouts, so the rename/merge work done on
+a layout the first time is stored here and replayed for every later file.
+"""
+import os, json, hashlib
+
+import settings
+
+CACHEPATH = os.path.join(settings.DATADIR, 'headercache.json')
+
+def signature(columns, fields_map = None):
+    header = [str(c) for c in columns]
+    fields = sorted((str(k), str(v)) for k, v in (fields_map or {}).items())
+    return hashlib.md5(json.dumps([header, fields]).encode('utf-8')).hexdigest()
+
+class HeaderCache(object):
+    def __init__(self, path = CACHEPATH):
+        self.path = path
+        self.plans = None
+
+    def read(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self):
+        if self.plans is None:
+            self.plans = self.read()
+        return self.plans
+
+    def get(self, columns, fields_map = None):
+        return self.load().get(signature(columns, fields_map))
+
+    def store(self, columns, fields_map = None, **plan):
+        """Merge `plan` into the entry for this header and write the cache.
+        The file is re-read first so plans stored by other processes are kept,
+        and replaced by rename so a concurrent reader never sees half of it."""
+        key = signature(columns, fields_map)
+        self.load().update(self.read())
+        self.plans.setdefault(key, {}).update(plan)
+        tmp = '{}.{}'.format(self.path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(self.plans, fh)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        return self.plans[key]
+
+HEADERS = HeaderCache()
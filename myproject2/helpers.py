@@ -1,6 +1,10 @@
 from collections import OrderedDict
 import os
 from formadv import *
+import snapshot
+from profileindex import ProfileIndex
+from descindex import DescIndex
+from profilecache import ProfileCache, VersionFile
 
 TABLEFIELDS = ['crd', 'company', 'numberofclients',
                'numberofaccts', 'numberofemployees',
@@ -18,14 +22,61 @@ PERCENTMAP = {v : k.replace('percent', '%').replace("More", ">") for k, v in PER
 REVPERCENTMAP = {v : k for k, v in PERCENTMAP.items()}
 CATEGORIESMAP = {'pct_aum' : 'AUM% / Client Type', 'client_types' : 'Types of Clients', 'compensation': 'Compensation', 'disclosures' : 'Reported Disclosures'}
 
-def getdescdata():
-    desctables = {}
-    for table in db.desctables:
-        desctables.update({
-            table : pd.read_csv(os.path.join(AdvFiling.LISTDIR, table + ".csv"))
-                })
-
-    return desctables
+class DataContext(object):
+    """Everything the pages read, loaded on first use from the current snapshot
+    written offline by `AdvFiling.store_snapshot` (`formadv.py --snapshot`).
+
+    Nothing is read at import, and the snapshot's numeric blocks are memory-mapped,
+    so workers forked after loading share them.  `refresh` drops it all once
+    the loader has bumped the data version.
+    """
+    def __init__(self, root = AdvFiling.SNAPSHOTDIR, versionpath = AdvFiling.VERSION_PATH):
+        self.root = root
+        self.versionfile = VersionFile(versionpath)
+        self.loaded = False
+
+    def refresh(self):
+        """Unload if the data version moved on; True if it did."""
+        if self.loaded and self.versionfile.get() != self.version:
+            self.__dict__ = {'root' : self.root, 'versionfile' : self.versionfile, 'loaded' : False}
+            return True
+        return False
+
+    def load(self):
+        self.version = self.versionfile.get(fresh = True)
+        found = snapshot.read(self.root)
+        if found is None:
+            raise IOError("No data snapshot in '{}'; build one with `python formadv.py --snapshot`".format(self.root))
+
+        frames, meta = found
+        self.desctables = {k[len('desc_'):] : v for k, v in frames.items() if k.startswith('desc_')}
+        self.data = frames['companylist']
+        self.dataprev = frames['previousqtr']
+        self.DESCMAP = meta['descmap']
+        self.REVDESCMAP = {v : k for k, v in self.DESCMAP.items()}
+        datemap = meta['datemap']
+        self.DATEMAP = dict(zip(map(int, datemap), pd.to_datetime(list(datemap.values()))))
+        self.numeric = frames['numeric']
+        self.formadv_ids = meta['formadv_ids']
+        self.CRDMAP = self.data.get_mapper('crd', 'company')
+        self.loaded = True
+
+    def __getattr__(self, name):
+        if name.startswith('__') or self.__dict__.get('loaded'):
+            if name == 'profiles':
+                self.profiles = ProfileIndex(self.desctables, self.numeric, self.data)
+            elif name == 'descindex':
+                self.descindex = DescIndex(self.desctables)
+            elif name == 'indextable':
+                data = self.data
+                self.indextable = data.ix[:, TABLEFIELDS].assign(
+                    assetsundermgmt = data['assetsundermgmt'].to_usd(),
+                    aumdiff = data.aumdiff.to_usd().str.strip('$'))
+            else:
+                raise AttributeError(name)
+        else:
+            self.load()
+        return getattr(self, name)
 
 def get_percentage_filters():
     """Get all descriptions that reflect a percentage , e.g. client_types, pct_aum, etc. for filter menu."""
@@ -41,18 +92,14 @@ def get_percentage_filters():
         percentages.update({i :PERCENTMAP[k]})
 
     filtermap = OrderedDict()
-    for (category, idxrng) in cdict:
-        keys = db.select('descriptions',
-            fields = ['id'],
-            subquery = "where id >= {} and id <= {}".format(*idxrng)
-                    ).iloc[:, 0].values
-
+    for (category, (lo, hi)) in cdict:
+        keys = sorted(k for k in context.REVDESCMAP if lo <= k <= hi)
         filtermap.update({
             category : {
                 'name' : CATEGORIESMAP[category],
                 'data' : {k : {
                     'percentages' : percentages,
-                    'name' : REVDESCMAP[k]
+                    'name' : context.REVDESCMAP[k]
                         } for k in keys
                             }}})
     return filtermap
@@ -62,7 +109,7 @@ def color_negative_red(val):
     return 'color: %s' % color
 
 def formatlink(rooturl, x):
-    return '<a href="{0}{1}">{2}</a>'.format(rooturl, x, CRDMAP[x])
+    return '<a href="{0}{1}">{2}</a>'.format(rooturl, x, context.CRDMAP[x])
 
 def formatnumeric(numeric):
     if not numeric.empty:
@@ -74,7 +121,7 @@ def formatnumeric(numeric):
 
 def formatdesc(desc):
     return desc.assign(
-        desc = desc.desc.map(REVDESCMAP), #
+        desc = desc.desc.map(context.REVDESCMAP), #
         percentage = desc.value.modify( #
                 desc.category != 'disclosures',
                 desc.value.quickmap(PERCENTMAP)),
@@ -105,7 +152,7 @@ def mostrecent(df):
 
 def getlisting(crd):
     return formataddress(
-        data.loc[data.crd == crd]\
+        context.profiles.getlisting(crd)\
             .T.iloc[:, 0]\
             .fillna('')\
             .to_dict())
@@ -117,14 +164,8 @@ def getdisclosures(desc):
     return desc.loc[is_disclosure]
 
 def getdata(crd):
-    desc = pd.DataFrame()
-    filings.id = crd
-
-    for k, v in desctables.items():
-        desc = desc.append(v.loc[v.crd == crd].assign(category = k))
-
-    numeric = formatnumeric(filings.select(fields = NUMERICFIELDS_WITH_ID))
-    desc = formatdesc(desc)
+    numeric = formatnumeric(context.profiles.getnumeric(crd).ix[:, NUMERICFIELDS_WITH_ID])
+    desc = formatdesc(context.profiles.getdesc(crd))
 
     __ = {}
     datalist = [
@@ -135,11 +176,11 @@ def getdata(crd):
     for df, name, fields in datalist:
         if df.empty:
             df = pd.DataFrame({
-                'formadv_id' : formadvs.id
+                'formadv_id' : context.formadv_ids
                     }).ix[:, fields]
         __.update({
             name : df.assign(
-                date = df.formadv_id.map(DATEMAP)
+                date = df.formadv_id.map(context.DATEMAP)
                     ).sort_values(by = 'date').fillna('n/a')
                         })
     __.update({
@@ -155,36 +196,45 @@ def getdata(crd):
             pass
     return __
 
-def filter_descriptions(table = 'client_types', desc2rank = {}, resetcache = False):
+def copied(value):
+    """`value` with its frames (also inside dicts) copied, so callers can change them."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, dict):
+        return type(value)((k, copied(v)) for k, v in value.items())
+    return value
+
+def cached(crd, kind, func, *args):
+    """A copy of `func(*args)` through `PROFILES`, keyed by data version, `crd` and `kind`."""
+    if context.refresh():
+        PROFILES.clear()
+    return copied(PROFILES.get((context.version, crd, kind), func, *args))
+
+def getprofile(crd):
+    return cached(crd, 'data', getdata, crd)
+
+def render_timeline(crd):
+    from bokeh.embed import components
+    from timeplot import timelineplot
+    return components(timelineplot(getprofile(crd)['numeric']))
+
+def getprofileplot(crd):
+    """(script, div) of the timeline plot of `crd`."""
+    return cached(crd, 'plot', render_timeline, crd)
+
+def getindexhtml():
+    return cached(None, 'indexhtml', lambda: to_styled_html(context.indextable))
+
+def filter_crds(table = 'client_types', desc2rank = {}, how = 'and', atleast = False):
+    """Sorted CRDs matching `desc2rank` ({description : ranking}); see `DescIndex.query`."""
+    return context.descindex.query(table, desc2rank, how = how, atleast = atleast)
+
+def filter_descriptions(table = 'client_types', desc2rank = {}, resetcache = False, atleast = False):
+    """Yield, per (description, ranking) of `desc2rank`, the rows of `table`
+    answering it (any ranking >= it with `atleast`), in table order."""
+    descdata = context.desctables[table]
     for description, ranking in desc2rank.items():
-        #sfunc = isearch(REVDESCMAP[int(description)])
-        #rdesc = {k : v for k,v in REVDESCMAP.items() if sfunc(str(v))}
-        descdata = desctables[table]
-        mask = (descdata['desc'] == int(description)) & (descdata['value'] == int(ranking))
-        result = descdata.loc[mask]
-        yield result
-
-db = IapdDB()
-DESCMAP = db.description_map
-REVDESCMAP = {v : k for k, v in DESCMAP.items()}
-
-#REVDESCMAP_CLIENT_TYPES = {k : v for k, v in REVDESCMAP.items() if k in in_client_types}
-
-formadvs = db.formadv().records
-DATEMAP = formadvs.get_mapper('id', 'filingdate')
-desctables = getdescdata()
-filings = db.advfiling(id_field = 'crd')
-
-data = pd.read_csv(AdvFiling.COMPANYLIST_PATH)
-data.sort_values(['aumdiff', 'assetsundermgmt'],
-    ascending = [1, 0],
-    inplace = True)
-
-dataprev = pd.read_csv(AdvFiling.PREVIOUSQTR_PATH)
-
-CRDMAP = data.get_mapper('crd', 'company')
-
-indextable = data.ix[:,TABLEFIELDS].assign(
-    assetsundermgmt = data['assetsundermgmt'].to_usd(),
-    aumdiff = data.aumdiff.to_usd().str.strip('$'))
+        yield descdata.iloc[context.descindex.rows(table, int(description), int(ranking), atleast = atleast)]
 
+context = DataContext()
+PROFILES = ProfileCache(maxsize = 256)
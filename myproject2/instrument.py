@@ -0,0 +1,133 @@
+"""Per-stage timings for the load pipeline.
+
+A `RunReport` adds up wall time, CPU time, rows in/out and peak memory
+growth per stage name (so a stage run once per chunk or table is one entry)
+and saves them as one JSON file per FormADV id, one section per phase.
+Times are exclusive: a stage recorded while another is open is taken out of
+the outer one, whose `total` still includes it.  `ru_maxrss` only ever
+grows, so each stage gets how far it raised the process peak plus the peak
+itself, labelled as such.  It costs a couple of clock reads per stage,
+cheap enough to leave on.
+"""
+import os, sys, json, time
+import numbers
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    import resource
+except ImportError: #windows
+    resource = None
+
+import pandas as pd
+
+import db
+from db import cputime
+
+REPORTDIR = db.advfolder('reports')
+
+def maxrss():
+    """Peak resident set size of this process, in MB."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+def countrows(data):
+    if isinstance(data, dict):
+        counts = [countrows(v) for v in data.values()]
+        return sum(c for c in counts if c is not None)
+    if isinstance(data, (pd.DataFrame, pd.Series, list, tuple)):
+        return len(data)
+    if isinstance(data, numbers.Integral):
+        return data
+
+class RunReport(object):
+    def __init__(self, key = None, phase = 'load', folder = REPORTDIR):
+        self.key = key
+        self.phase = phase
+        self.folder = folder
+        self.started = datetime.now()
+        self.stages = OrderedDict()
+        self.open = []
+
+    def add(self, name, wall, cpu, rows_in = None, rows_out = None, growth = 0.0, inner = None):
+        """Record a call of `name` that took `wall`/`cpu` seconds in all, of
+        which `inner` (a dict like the one `stage` keeps) went to nested stages."""
+        if self.open:
+            outer = self.open[-1]
+            outer['wall'] += wall
+            outer['cpu'] += cpu
+            outer['growth'] += growth
+
+        inner = inner or {'wall' : 0.0, 'cpu' : 0.0, 'growth' : 0.0}
+        stage = self.stages.setdefault(name, OrderedDict([
+            ('calls', 0), ('wall', 0.0), ('total', 0.0), ('cpu', 0.0),
+            ('rows_in', 0), ('rows_out', 0),
+            ('peak_growth_mb', 0.0), ('process_peak_mb', None)]))
+        stage['calls'] += 1
+        stage['wall'] += wall - inner['wall']
+        stage['total'] += wall
+        stage['cpu'] += cpu - inner['cpu']
+        stage['rows_in'] += rows_in or 0
+        stage['rows_out'] += rows_out or 0
+        stage['peak_growth_mb'] += max(growth - inner['growth'], 0.0)
+        stage['process_peak_mb'] = maxrss()
+
+    @contextmanager
+    def stage(self, name, rows_in = None):
+        """Time the block as `name`; set `counts['rows_out']` inside it."""
+        counts = {'rows_out' : None}
+        inner = {'wall' : 0.0, 'cpu' : 0.0, 'growth' : 0.0}
+        self.open.append(inner)
+        wall, cpu, peak = time.time(), cputime(), maxrss()
+        try:
+            yield counts
+        finally:
+            self.open.pop()
+            growth = (maxrss() - peak) if peak is not None else 0.0
+            self.add(name, time.time() - wall, cputime() - cpu, rows_in, counts['rows_out'],
+                growth = growth, inner = inner)
+
+    def timed(self, name, func, *args, **kwds):
+        """`func(*args, **kwds)` timed as `name`; rows in/out are counted
+        from the first argument and the result."""
+        with self.stage(name, countrows(args[0]) if args else None) as counts:
+            result = func(*args, **kwds)
+            counts['rows_out'] = countrows(result)
+        return result
+
+    def iterate(self, name, iterable):
+        """Yield from `iterable`, timing the production of each item as `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as counts:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                counts['rows_out'] = countrows(item)
+            yield item
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, '{}.json'.format(self.key))
+
+    def todict(self):
+        return OrderedDict([
+            ('started', self.started.isoformat()),
+            ('wall', sum(s['wall'] for s in self.stages.values())),
+            ('stages', self.stages)])
+
+    def save(self):
+        """Write this phase into the report file of `key`; other phases are kept."""
+        if self.key is None:
+            return
+        try:
+            with open(self.path) as fh:
+                data = json.load(fh, object_pairs_hook = OrderedDict)
+        except (IOError, OSError, ValueError):
+            data = OrderedDict()
+        data[self.phase] = self.todict()
+        with open(self.path, 'w') as fh:
+            json.dump(data, fh, indent = 2)
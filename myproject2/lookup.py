@@ -0,0 +1,64 @@
+"""Vectorized lookups over the small answer vocabularies of Form ADV columns.
+
+Ranking columns hold a handful of distinct strings ("1-10", "Up to 25 percent",
+Excel's "Nov-50"), so every map or regex is applied once per category and
+broadcast back through the integer codes.
+"""
+import re
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def astext(value):
+    """`value` as unicode; byte strings are decoded as utf-8."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return u'%s' % (value,)
+
+def categorize(values):
+    """Return (codes, categories); missing values get code -1."""
+    return pd.factorize(pd.Series(values).values)
+
+def matchcategories(values, pattern):
+    """Boolean mask of `values` that match `pattern`, searched once per category."""
+    codes, categories = categorize(values)
+    matched = np.array([bool(re.search(pattern, astext(c))) for c in categories] + [False])
+    return matched[codes]
+
+class CategoryLookup(object):
+    """Map values through `mapping` by categorical code.
+
+    Values not in `mapping` are passed through unchanged, as `quickmap` does,
+    and collected in `unmapped` (and logged once) unless they match `ignore`.
+    Only the first `maxunmapped` are kept; later ones are neither kept nor logged.
+    """
+    def __init__(self, mapping, name = None, ignore = None, maxunmapped = 500):
+        self.mapping = mapping
+        self.name = name or 'lookup'
+        self.ignore = re.compile(ignore) if ignore else None
+        self.maxunmapped = maxunmapped
+        self.unmapped = set()
+
+    def report(self, categories):
+        room = self.maxunmapped - len(self.unmapped)
+        if room <= 0:
+            return
+        new = sorted(set(astext(c) for c in categories) - self.unmapped)
+        new = [c for c in new if not (self.ignore and self.ignore.search(c))][:room]
+        if new:
+            self.unmapped.update(new)
+            logger.warning(u"%s: unmapped categories %s", self.name, u', '.join(new))
+            if len(self.unmapped) >= self.maxunmapped:
+                logger.warning("%s: %s unmapped categories seen, no longer reporting",
+                    self.name, self.maxunmapped)
+
+    def __call__(self, values):
+        series = values if isinstance(values, pd.Series) else pd.Series(values)
+        codes, categories = categorize(series)
+        table = np.empty(len(categories) + 1, dtype = object)
+        table[:-1] = [self.mapping.get(c, c) for c in categories]
+        table[-1] = np.nan
+        self.report(c for c in categories if c not in self.mapping)
+        return pd.Series(table[codes], index = series.index, name = series.name)
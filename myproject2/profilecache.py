@@ -0,0 +1,91 @@
+"""Bounded LRU cache for assembled adviser profiles, and the data version that keys it.
+
+The loader bumps an integer in a version file once a new snapshot is
+current; readers put the version in their cache keys, so entries from
+older data are never hit again and age out, and no worker has to restart.
+Readers watch the file through `VersionFile`, which costs at most one stat
+every few seconds.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+def readversion(path):
+    try:
+        with open(path) as fh:
+            return int(fh.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+def bumpversion(path):
+    version = readversion(path) + 1
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        fh.write(str(version))
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+    return version
+
+class VersionFile(object):
+    """The version in `path`, re-read only when the file is replaced (its inode
+    or mtime changes) and stat'ed at most once every `interval` seconds."""
+    def __init__(self, path, interval = 5):
+        self.path = path
+        self.interval = interval
+        self.checked = None
+        self.stamp = None
+        self.version = 0
+
+    def get(self, fresh = False):
+        """The current version; `fresh` skips the timer."""
+        now = time.time()
+        if not fresh and self.checked is not None and now - self.checked < self.interval:
+            return self.version
+        self.checked = now
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_ino, stat.st_mtime)
+        except OSError:
+            stamp = None
+        if fresh or stamp != self.stamp:
+            self.stamp = stamp
+            self.version = readversion(self.path)
+        return self.version
+
+class ProfileCache(object):
+    """LRU of up to `maxsize` values with hit, miss and eviction counters."""
+    def __init__(self, maxsize = 256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, func, *args, **kwds):
+        """Cached value of `key`, built with `func(*args, **kwds)` on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                value = self.entries[key] = self.entries.pop(key)
+                return value
+            self.misses += 1
+
+        value = func(*args, **kwds)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return OrderedDict([
+            ('hits', self.hits), ('misses', self.misses),
+            ('evictions', self.evictions),
+            ('size', len(self.entries)), ('maxsize', self.maxsize)])
@@ -0,0 +1,63 @@
+"""Per-CRD slices of the snapshot frames, for the adviser profile pages.
+
+Each frame is indexed once per data refresh: its rows are (stably) ordered by
+CRD and every CRD keeps the start/stop of its run, so a profile costs a
+binary search and a slice instead of a scan of every table.
+"""
+import numpy as np
+import pandas as pd
+
+def decoded(df):
+    """`df` with its categorical (snapshot text) columns as plain objects, so a
+    profile can be filled and formatted like any other frame."""
+    cats = [c for c in df.columns if df[c].dtype.name == 'category']
+    if not cats:
+        return df
+    return df.assign(**{c : df[c].astype(object) for c in cats})
+
+class SliceIndex(object):
+    """Rows of `df` by `key`.  Frames already sorted by `key` (as the snapshot
+    writes them) are sliced in place; others go through a sort order."""
+    def __init__(self, df, key = 'crd'):
+        self.df = df
+        values = df[key].values
+        if len(values) and (np.diff(values) < 0).any():
+            self.order = np.argsort(values, kind = 'mergesort')
+            values = values[self.order]
+        else:
+            self.order = None
+        self.keys, self.starts = np.unique(values, return_index = True)
+        self.stops = np.append(self.starts[1:], len(values))
+
+    def bounds(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.starts[i], self.stops[i]
+        return 0, 0
+
+    def get(self, key):
+        start, stop = self.bounds(key)
+        if self.order is None:
+            return decoded(self.df.iloc[start:stop])
+        return decoded(self.df.iloc[self.order[start:stop]])
+
+class ProfileIndex(object):
+    """Desc rows (by table), numeric history and listing of each CRD."""
+    def __init__(self, desctables, numeric, listing, key = 'crd'):
+        self.desc = {table : SliceIndex(df, key) for table, df in desctables.items()}
+        self.numeric = SliceIndex(numeric, key)
+        self.listing = SliceIndex(listing, key)
+
+    def getdesc(self, crd):
+        """Desc rows of `crd` from every table, tagged with their table as `category`."""
+        parts = [index.get(crd).assign(category = table)
+            for table, index in self.desc.items()]
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, ignore_index = True)
+
+    def getnumeric(self, crd):
+        return self.numeric.get(crd)
+
+    def getlisting(self, crd):
+        return self.listing.get(crd)
@@ -1,23 +1,8 @@
-FilingAlias = Filing.alias()
-
-#Subquery to get max filing per adviser.
-
-subquery = (FilingAlias.select(
-                FilingAlias.adviser,
-                fn.MAX(FilingAlias.id).alias('most_recent'))
-            .group_by(FilingAlias.adviser)
-            .alias('most_recent_subquery'))
-
-# Query for filings and join using the subquery
-    #to match the filings's adviser and id.
+#Most recent filing per adviser, maintained by LatestFiling.refresh on each load.
 
 most_recent_filings = (
-    Filing.select(Filing.id.alias("filing_id"), Adviser.crd)
+    LatestFiling.select(LatestFiling.filing.alias("filing_id"), Adviser.crd)
          .join(Adviser)
-         .switch(Filing)
-         .join(subquery, on=(
-            (Filing.id == subquery.c.most_recent) &
-            (Filing.adviser == subquery.c.adviser_id)))
                 )
 
 #this will be the index table
@@ -30,6 +30,17 @@ DBTABLES = {
         'constraints' : ['filingdate', 'filename']
             },
 
+    'latest_advfiling' : {
+        'fields' : [
+            ('crd', "INT(11) NOT NULL",),
+            ('id', "INT(11) NOT NULL",),
+            ('formadv_id', "INT(11) NOT NULL",),
+            ('prev_id', "INT(11) DEFAULT NULL",),
+            ('prev_formadv_id', "INT(11) DEFAULT NULL",),
+                ],
+        'constraints' : ['crd']
+            },
+
     'competitors' : {
         'fields' : [('name', "VARCHAR(150)")],
         'constraints' : ['name']
@@ -0,0 +1,124 @@
+"""Read-only binary snapshots of DataFrames.
+
+A snapshot is a folder under `root` holding, per frame, one 2-D .npy block per
+numeric dtype and one code array per text column, plus `snapshot.json` with
+the column layout, the text categories and any metadata.  Numeric blocks and
+codes are memory-mapped on load, so forked workers share their pages instead
+of each parsing CSVs.  `root/CURRENT` names the snapshot readers should use.
+
+Frames come back with a RangeIndex, their columns grouped by dtype and text
+columns as categoricals.
+"""
+import os, json, time, shutil
+from collections import OrderedDict
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+
+CURRENT = 'CURRENT'
+LAYOUT = 'snapshot.json'
+
+def jsonable(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+def codetype(categories):
+    """Smallest signed integer dtype holding `categories` codes and -1 for missing."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if len(categories) < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def writeframe(path, frame, df):
+    blocks, texts = OrderedDict(), OrderedDict()
+    for col in df.columns:
+        kind = df[col].dtype
+        if kind.kind in 'biufM':
+            blocks.setdefault(kind.name, []).append(col)
+        else:
+            texts[col] = None
+
+    spec = {'length' : len(df), 'blocks' : [], 'texts' : []}
+    for i, (dtype, cols) in enumerate(blocks.items()):
+        values = [df[c].values.view('int64') if dtype.startswith('datetime64')
+            else df[c].values for c in cols]
+        np.save(os.path.join(path, '{}.block{}.npy'.format(frame, i)), np.vstack(values))
+        spec['blocks'].append({'dtype' : dtype, 'columns' : [str(c) for c in cols]})
+
+    for i, col in enumerate(texts):
+        codes, categories = pd.factorize(df[col].values)
+        np.save(os.path.join(path, '{}.text{}.npy'.format(frame, i)), codes.astype(codetype(categories)))
+        spec['texts'].append({'column' : str(col), 'categories' : list(categories)})
+    return spec
+
+def readframe(path, frame, spec):
+    parts = []
+    for i, block in enumerate(spec['blocks']):
+        values = np.load(os.path.join(path, '{}.block{}.npy'.format(frame, i)), mmap_mode = 'r')
+        part = pd.DataFrame(values.T, columns = block['columns'], copy = False)
+        if block['dtype'].startswith('datetime64'):
+            part = part.astype(block['dtype'])
+        parts.append(part)
+
+    for i, text in enumerate(spec['texts']):
+        codes = np.load(os.path.join(path, '{}.text{}.npy'.format(frame, i)), mmap_mode = 'r')
+        parts.append(pd.DataFrame({text['column'] :
+            pd.Categorical.from_codes(codes, text['categories'])}))
+
+    if not parts:
+        return pd.DataFrame(index = range(spec['length']))
+    return pd.concat(parts, axis = 1, copy = False)
+
+def current(root):
+    try:
+        with open(os.path.join(root, CURRENT)) as fh:
+            return fh.read().strip() or None
+    except IOError:
+        return None
+
+def setcurrent(root, name):
+    tmp = os.path.join(root, '{}.{}'.format(CURRENT, os.getpid()))
+    with open(tmp, 'w') as fh:
+        fh.write(name)
+    if os.path.exists(os.path.join(root, CURRENT)):
+        os.remove(os.path.join(root, CURRENT))
+    os.rename(tmp, os.path.join(root, CURRENT))
+
+def prune(root, keep = 2):
+    """Remove all but the `keep` newest snapshots; workers may still map the previous one."""
+    names = sorted(name for name in os.listdir(root)
+        if os.path.isdir(os.path.join(root, name)))
+    for name in names[:-keep]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors = True)
+
+def write(root, frames, meta = None):
+    """Write `frames` ({name : DataFrame}) and `meta` as a new snapshot and make it current."""
+    name = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid())
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    layout = {
+        'frames' : {frame : writeframe(path, frame, df) for frame, df in frames.items()},
+        'meta' : meta or {},
+            }
+
+    with open(os.path.join(path, LAYOUT), 'w') as fh:
+        json.dump(layout, fh, default = jsonable)
+    setcurrent(root, name)
+    prune(root)
+    return path
+
+def read(root):
+    """({name : DataFrame}, meta) of the current snapshot, or None if there is none."""
+    name = current(root)
+    if name is None:
+        return None
+
+    path = os.path.join(root, name)
+    with open(os.path.join(path, LAYOUT)) as fh:
+        layout = json.load(fh)
+    frames = {frame : readframe(path, frame, spec)
+        for frame, spec in layout['frames'].items()}
+    return frames, layout['meta']
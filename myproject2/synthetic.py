@@ -0,0 +1,151 @@
+"""Deterministic synthetic Form ADV files for exercising the loader without SEC zips.
+
+Headers are drawn from `advfiling_fields_map.json`, in the two layouts the SEC
+has used (item codes like "5D(1)(a)" and question codes like "Q5D1A"), and the
+answers use the same vocabularies as the real files.
+"""
+import os, re, json, zipfile
+import numpy as np
+import pandas as pd
+
+import settings
+
+FIELDS_PATH = os.path.join(settings.CONFIGDIR, 'fields_map', 'advfiling_fields_map.json')
+OUTDIR = os.path.join(settings.DATADIR, 'synthetic')
+
+IDENTITY = [
+    'Organization CRD#', 'SEC#', 'Primary Business Name', 'Legal Name',
+    'Main Office Street Address 1', 'Main Office Street Address 2',
+    'Main Office City', 'Main Office State', 'Main Office Country',
+    'Main Office Postal Code', 'Main Office Telephone Number',
+    'Main Office Facsimile Number', 'Website Address', 'Latest ADV Filing Date',
+        ]
+
+LAYOUTS = {
+    'items' : re.compile(r'^\d+[A-Z]?(?:\(\d+\))?(?:\([a-z]\))?(?:-.+)?$'),
+    'questions' : re.compile(r'^Q\d+[A-Z]\d*[A-Z]?(?:-.+)?$'),
+        }
+
+PERCENTS = ["0 percent", "Up to 10 percent", "Up to 25 percent", "Up to 50 percent",
+    "Up to 75 percent", "More than 75 percent", "100 percent", "1-10 percent",
+    "11-25 percent", "26-50 percent", "51-75 percent", "76-99 percent"]
+EMPLOYEES = ["1-5", "6-10", "11-50", "51-250", "251-500", "501-1000", "More than 1000", "Nov-50"]
+CLIENTS = ["1-10", "11-25", "26-100", "101-250", "251-500", "More than 500"]
+SPECIFY = ["Family offices", "Endowments", "Sovereign wealth funds", "Wrap program sponsors"]
+CITIES = [("New York", "NY", "10022"), ("Boston", "MA", "02110"), ("Chicago", "IL", "60606"),
+    ("San Francisco", "CA", "94105"), ("Dallas", "TX", "75201"), ("Denver", "CO", "80202")]
+
+def load_fields_map(path = FIELDS_PATH):
+    with open(path) as fh:
+        return json.load(fh)
+
+def header(layout = 'items', fields_map = None):
+    """Raw header for `layout`: identity columns then every item of the layout,
+    one raw name per mapped field, in sorted order."""
+    fields_map = fields_map or load_fields_map()
+    pattern = LAYOUTS[layout]
+    columns, seen = list(IDENTITY), set(fields_map[c] for c in IDENTITY)
+    for raw in sorted(fields_map):
+        name = fields_map[raw]
+        if pattern.match(raw) and isinstance(name, type(u'')) and name not in seen and raw != name:
+            columns.append(raw)
+            seen.add(name)
+    return columns
+
+class Generator(object):
+    """Answers for `advisers` firms, reproducible from `seed`."""
+    def __init__(self, advisers = 1000, seed = 0, fields_map = None):
+        self.advisers = advisers
+        self.seed = seed
+        self.fields_map = fields_map or load_fields_map()
+        self.crds = 100000 + np.arange(advisers)
+
+    def sometimes(self, rng, values, p):
+        values = np.asarray(values, dtype = object)
+        values[rng.rand(len(values)) >= p] = np.nan
+        return values
+
+    def column(self, rng, name, filingdate, quarter):
+        n = self.advisers
+        if name == 'crd':
+            return self.crds
+        if name == 'sec_number':
+            return np.array(['801-{:05d}'.format(i) for i in self.crds - 100000])
+        if name in ('company', 'legalname'):
+            renamed = (self.crds + quarter) % 97 == 0
+            return np.array(['Adviser {} {}'.format(crd, 'Partners' if r else 'Capital LLC')
+                for crd, r in zip(self.crds, renamed)])
+        if name == 'address1':
+            return np.array(['{} Main Street'.format(i % 900 + 1) for i in self.crds])
+        if name == 'address2':
+            return self.sometimes(rng, ['Suite {}'.format(i % 50 + 100) for i in self.crds], .3)
+        if name in ('city', 'state', 'zip'):
+            idx = self.crds % len(CITIES)
+            return np.array([CITIES[i][('city', 'state', 'zip').index(name)] for i in idx])
+        if name == 'country':
+            return np.repeat('United States', n)
+        if name in ('phone', 'fax'):
+            return np.array(['212-555-{:04d}'.format(i % 10000) for i in self.crds])
+        if name == 'url':
+            return self.sometimes(rng, ['www.adviser{}.com'.format(i) for i in self.crds], .7)
+        if re.search('date$', name):
+            return np.repeat(filingdate.strftime('%m/%d/%Y'), n)
+        if name == 'numberofemployees':
+            return rng.choice(EMPLOYEES, n)
+        if name == 'numberofclients':
+            return rng.choice(CLIENTS, n)
+        if re.search('^(?:numberof|number_of).*specify$', name):
+            return self.sometimes(rng, rng.randint(1000, 20000, n), .05)
+        if re.search('specify$', name):
+            return self.sometimes(rng, rng.choice(SPECIFY, n), .05)
+        if re.search('^(?:client_types|pct_aum)', name):
+            return self.sometimes(rng, rng.choice(PERCENTS, n), .4)
+        if re.search('^(?:assetsundermgmt|aum_|dollar_amt)', name):
+            return np.round(rng.lognormal(18, 2, n))
+        if re.search('^(?:number_of|numberof)', name):
+            return rng.randint(0, 5000, n)
+        return np.where(rng.rand(n) < .2, 'Y', 'N')
+
+    def frame(self, filingdate, layout = 'items', quarter = 0):
+        rng = np.random.RandomState(self.seed + quarter)
+        columns = header(layout, self.fields_map)
+        return pd.DataFrame({raw : self.column(rng, self.fields_map[raw], filingdate, quarter)
+            for raw in columns}, columns = columns)
+
+def quarterdates(start, quarters):
+    start = pd.Timestamp(start)
+    return [(start + pd.DateOffset(months = 3 * q)).date() for q in range(quarters)]
+
+def write_zip(df, filingdate, outdir = OUTDIR):
+    """Write `df` the way the SEC ships it: ia%m%d%y.zip holding one latin-1 CSV."""
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    path = os.path.join(outdir, filingdate.strftime('ia%m%d%y.zip'))
+    csvname = filingdate.strftime('IA_ADV_Base_A_%Y%m%d.csv')
+    archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        archive.writestr(csvname, df.to_csv(index = False, encoding = 'latin-1'))
+    finally:
+        archive.close()
+    return path
+
+def generate(advisers = 1000, quarters = 1, start = '2017-01-01', layout = 'items', seed = 0, outdir = OUTDIR):
+    """Write `quarters` quarterly files for `advisers` firms; returns [(date, path)]."""
+    generator = Generator(advisers = advisers, seed = seed)
+    files = []
+    for quarter, filingdate in enumerate(quarterdates(start, quarters)):
+        df = generator.frame(filingdate, layout = layout, quarter = quarter)
+        files.append((filingdate, write_zip(df, filingdate, outdir = outdir)))
+    return files
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--advisers', type = int, default = 1000)
+    parser.add_argument('--quarters', type = int, default = 1)
+    parser.add_argument('--layout', choices = sorted(LAYOUTS), default = 'items')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    for filingdate, path in generate(args.advisers, args.quarters, layout = args.layout, seed = args.seed):
+        print(path)
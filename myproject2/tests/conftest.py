@@ -0,0 +1,8 @@
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#db reads the backend at import and makes its data folders under the cwd
+WORKDIR = tempfile.mkdtemp(prefix = 'adviserinfo-tests-')
+os.environ.setdefault('ADVISERINFO_SQLITE', os.path.join(WORKDIR, 'adviserinfo.db'))
+os.chdir(WORKDIR)
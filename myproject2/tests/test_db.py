@@ -0,0 +1,57 @@
+from datetime import date
+import pytest
+
+db = pytest.importorskip('db')
+
+KEYFIELDS = ['adviser', 'number', 'district']
+
+@pytest.fixture
+def courtcases():
+    db.setup()
+    db.Courtcase.delete().execute()
+    yield db.Courtcase
+    db.Courtcase.delete().execute()
+
+def case(number, district, adviser = 1):
+    return {'adviser' : adviser, 'number' : number, 'district' : district, 'date' : date(2010, 1, 1)}
+
+def test_flush_inserts_each_new_key_once(courtcases):
+    table = db.InternTable(courtcases, KEYFIELDS)
+    keys = [table.intern(row) for row in [case('A-1', 'NY'), case('A-2', 'NY'), case('A-1', 'NY')]]
+    assert table.flush() == 2
+    assert courtcases.select().count() == 2
+    assert table[keys[0]] == table[keys[2]] != table[keys[1]]
+    assert table.flush() == 0
+
+def test_flush_resolves_keys_already_on_file(courtcases):
+    table = db.InternTable(courtcases, KEYFIELDS)
+    key = table.intern(case('A-1', 'NY'))
+    table.flush()
+
+    again = db.InternTable(courtcases, KEYFIELDS)
+    assert again.intern(case('A-1', 'NY')) == key
+    assert again.flush() == 0
+    assert again[key] == table[key]
+
+def test_casefold_ignores_case_and_trailing_spaces(courtcases):
+    table = db.InternTable(courtcases, KEYFIELDS, casefold = True)
+    key = table.intern(case('A-1', 'NY'))
+    table.flush()
+
+    loaded = db.InternTable(courtcases, KEYFIELDS, casefold = True).loadin('adviser', [1])
+    assert loaded.getkey(case('a-1 ', 'ny')) == key
+    assert loaded[key] == table[key]
+
+def test_keys_are_cut_to_the_column_width(courtcases):
+    table = db.InternTable(courtcases, KEYFIELDS)
+    key = table.intern(case('X' * 40, 'NY'))
+    table.flush()
+
+    loaded = db.InternTable(courtcases, KEYFIELDS).loadin('adviser', [1])
+    assert loaded.getkey(case('X' * 35, 'NY')) == key
+    assert key in loaded
+
+def test_float_keys_compare_at_stored_precision(courtcases):
+    table = db.InternTable(courtcases, KEYFIELDS + ['renderedfine'])
+    row = dict(case('A-1', 'NY'), renderedfine = 1234567.891)
+    assert table.getkey(row) == table.getkey(dict(row, renderedfine = 1234570.0))
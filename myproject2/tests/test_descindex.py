@@ -0,0 +1,41 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+from descindex import DescIndex
+
+@pytest.fixture
+def descdata():
+    rng = np.random.RandomState(1)
+    df = pd.DataFrame({
+        'crd' : rng.randint(1, 50, 500),
+        'desc' : rng.randint(1, 6, 500).astype(float),
+        'value' : rng.randint(0, 7, 500).astype(float),
+            })
+    df.loc[::37, 'value'] = np.nan
+    return df
+
+def masked(df, desc, value, atleast = False):
+    """What filter_descriptions did before the index: a masked scan per criterion."""
+    hit = df['value'] >= value if atleast else df['value'] == value
+    return df.loc[(df['desc'] == desc) & hit]
+
+@pytest.mark.parametrize('atleast', [False, True])
+@pytest.mark.parametrize('desc, value', [(1, 0), (3, 4), (5, 6), (9, 1)])
+def test_rows_match_the_masked_scan(descdata, desc, value, atleast):
+    index = DescIndex({'client_types' : descdata})
+    found = descdata.iloc[index.rows('client_types', desc, value, atleast = atleast)]
+    expected = masked(descdata, desc, value, atleast)
+
+    pd.testing.assert_frame_equal(found, expected)
+    assert index.lookup('client_types', desc, value, atleast = atleast).tolist() == \
+        sorted(expected.crd.unique())
+
+def test_query_intersects_or_unions_criteria(descdata):
+    index = DescIndex({'client_types' : descdata})
+    desc2rank = {'1' : '2', '2' : '3'}
+    crds = [set(masked(descdata, int(d), int(r)).crd) for d, r in desc2rank.items()]
+
+    assert index.query('client_types', desc2rank).tolist() == sorted(crds[0] & crds[1])
+    assert index.query('client_types', desc2rank, how = 'or').tolist() == sorted(crds[0] | crds[1])
+    assert index.query('client_types', {}).tolist() == []
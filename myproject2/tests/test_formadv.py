@@ -0,0 +1,29 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+formadv = pytest.importorskip('formadv')
+
+def filings(*rows):
+    return pd.DataFrame(list(rows), columns = ['id', 'crd', 'formadv_id'])
+
+def test_rankfilings_picks_newest_and_previous_filing():
+    ranked = formadv.rankfilings(filings(
+        (1, 100, 1), (5, 100, 3), (3, 100, 2),
+        (2, 200, 1),
+        (4, 300, 2), (6, 300, 2),
+            )).set_index('crd')
+
+    assert ranked.loc[100, ['id', 'formadv_id', 'prev_id', 'prev_formadv_id']].tolist() == [5, 3, 3, 2]
+    assert ranked.loc[300, ['id', 'prev_id']].tolist() == [6, 4]
+
+def test_rankfilings_leaves_prev_null_for_single_filings():
+    ranked = formadv.rankfilings(filings((2, 200, 1), (7, 100, 4))).set_index('crd')
+    assert ranked.loc[200, 'id'] == 2
+    assert ranked.loc[200, 'prev_id'] is None
+    assert ranked.loc[200, 'prev_formadv_id'] is None
+
+def test_rankfilings_of_no_filings():
+    assert formadv.rankfilings(filings()).empty
+
+def test_sqlvalues_writes_null_for_missing_prev_ids():
+    assert formadv.sqlvalues([(1, 2, None), (3, 4, 5)]) == '(1, 2, NULL), (3, 4, 5)'
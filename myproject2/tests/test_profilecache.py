@@ -0,0 +1,59 @@
+import profilecache
+from profilecache import ProfileCache, VersionFile, readversion, bumpversion
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ProfileCache(maxsize = 2)
+    calls = []
+    build = lambda key: calls.append(key) or key * 10
+
+    assert cache.get(1, build, 1) == 10
+    cache.get(2, build, 2)
+    cache.get(1, build, 1)
+    cache.get(3, build, 3)
+    assert cache.get(1, build, 1) == 10
+    cache.get(2, build, 2)
+
+    assert calls == [1, 2, 3, 2]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (2, 4, 2, 2)
+
+def test_clear():
+    cache = ProfileCache()
+    cache.get('a', lambda: 1)
+    cache.clear()
+    assert cache.stats()['size'] == 0
+
+def test_bumpversion(tmpdir):
+    path = str(tmpdir.join('version'))
+    assert readversion(path) == 0
+    assert bumpversion(path) == 1
+    assert bumpversion(path) == 2
+    assert readversion(path) == 2
+
+def test_versionfile_rereads_only_after_its_interval(tmpdir):
+    path = str(tmpdir.join('version'))
+    bumpversion(path)
+    version = VersionFile(path, interval = 60)
+    assert version.get() == 1
+
+    bumpversion(path)
+    assert version.get() == 1
+    assert version.get(fresh = True) == 2
+
+def test_versionfile_reads_only_a_replaced_file(tmpdir, monkeypatch):
+    path = str(tmpdir.join('version'))
+    bumpversion(path)
+    reads = []
+    monkeypatch.setattr(profilecache, 'readversion', lambda path: reads.append(path) or readversion(path))
+    version = VersionFile(path, interval = 0)
+
+    assert version.get() == version.get() == 1
+    assert len(reads) == 1
+
+    bumpversion(path)
+    del reads[:]
+    assert version.get() == version.get() == 2
+    assert len(reads) == 1
+
+def test_versionfile_without_file(tmpdir):
+    assert VersionFile(str(tmpdir.join('missing'))).get() == 0
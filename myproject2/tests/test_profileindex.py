@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+from profileindex import SliceIndex, ProfileIndex
+
+def scan(df, crd):
+    """What the profile pages did before the index: a masked scan."""
+    return df.loc[df.crd == crd]
+
+@pytest.fixture
+def desctables():
+    rng = np.random.RandomState(0)
+    def table(n):
+        return pd.DataFrame({
+            'crd' : rng.randint(1, 20, n),
+            'desc' : rng.randint(1, 10, n),
+            'value' : rng.randint(0, 7, n),
+                })
+    return {'client_types' : table(200), 'pct_aum' : table(150).sort_values('crd', kind = 'mergesort')}
+
+@pytest.mark.parametrize('crd', [1, 5, 19, 25])
+def test_slices_match_the_scan(desctables, crd):
+    for df in desctables.values():
+        found = SliceIndex(df).get(crd)
+        pd.testing.assert_frame_equal(found, scan(df, crd))
+
+def test_getdesc_tags_each_table(desctables):
+    listing = pd.DataFrame({'crd' : [5], 'company' : pd.Categorical(['Firm'])})
+    numeric = pd.DataFrame({'crd' : [5, 5, 6], 'assetsundermgmt' : [1.0, 2.0, 3.0]})
+    index = ProfileIndex(desctables, numeric, listing)
+
+    desc = index.getdesc(5)
+    for table, df in desctables.items():
+        expected = scan(df, 5)
+        assert (desc.category == table).sum() == len(expected)
+    pd.testing.assert_frame_equal(index.getnumeric(5), scan(numeric, 5))
+    assert index.getlisting(5).company.dtype == object
+    assert index.getlisting(7).empty
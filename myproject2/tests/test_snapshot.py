@@ -0,0 +1,31 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+import snapshot
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({
+        'crd' : [3, 1, 2],
+        'aum' : [1.5, np.nan, 3.0],
+        'filed' : pd.to_datetime(['2017-01-01', '2017-02-01', '2017-03-01']),
+        'company' : ['A', np.nan, 'C'],
+            })
+
+def test_round_trip(tmpdir, frame):
+    snapshot.write(str(tmpdir), {'firms' : frame}, meta = {'version' : 1})
+    frames, meta = snapshot.read(str(tmpdir))
+    found = frames['firms'][frame.columns]
+
+    assert meta == {'version' : 1}
+    assert found['company'].dtype.name == 'category'
+    pd.testing.assert_frame_equal(found.assign(company = found.company.astype(object)), frame)
+
+def test_codes_use_the_smallest_dtype():
+    assert snapshot.codetype(range(10)) == np.int8
+    assert snapshot.codetype(range(200)) == np.int16
+    assert snapshot.codetype(range(40000)) == np.int32
+
+def test_read_without_snapshot(tmpdir):
+    assert snapshot.read(str(tmpdir)) is None